@@ -0,0 +1,130 @@
+import os
+from typing import Optional, Sequence, Union
+from grid import TILE_DTYPE
+
+import numpy as np
+
+# Binaeres Level Archiv: fester Header + Records gleicher Groesse, damit np.memmap jeden Level direkt adressieren kann
+#   Header (32 Byte): magic, version, bits pro Tile, breite, hoehe, anzahl
+#   Record: tiles (uint8 (hoehe, breite) oder 3 Bit gepackt), fitness float32, generation int32
+ARCHIV_MAGIC = b"EALV"
+ARCHIV_VERSION = 1
+HEADER_GROESSE = 32
+HEADER_DTYPE = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u2"),
+    ("bits", "u1"),
+    ("reserviert", "u1"),
+    ("breite", "<u2"),
+    ("hoehe", "<u2"),
+    ("anzahl", "<u8"),
+])
+# Tiles 0-4 passen in 3 Bit
+TILE_BITS = 3
+
+
+class LevelArchiv:
+
+    def __init__(self, pfad: Union[str, os.PathLike], breite: int = 20, hoehe: int = 10, bits: int = 8):
+        # existiert die Datei, kommen breite/hoehe/bits aus dem Header, sonst wird ein leeres Archiv angelegt
+        self.pfad = os.fspath(pfad)
+
+        if os.path.exists(self.pfad):
+            header = np.fromfile(self.pfad, dtype=HEADER_DTYPE, count=1)
+            if len(header) == 0 or header["magic"][0] != ARCHIV_MAGIC:
+                raise ValueError(f"{self.pfad} ist kein Level Archiv")
+            if header["version"][0] != ARCHIV_VERSION:
+                raise ValueError(f"Archiv Version {header['version'][0]} wird nicht unterstuetzt")
+            self.breite = int(header["breite"][0])
+            self.hoehe = int(header["hoehe"][0])
+            self.bits = int(header["bits"][0])
+            self.anzahl = int(header["anzahl"][0])
+        else:
+            if bits not in (8, TILE_BITS):
+                raise ValueError(f"bits muss 8 oder {TILE_BITS} sein")
+            self.breite = breite
+            self.hoehe = hoehe
+            self.bits = bits
+            self.anzahl = 0
+            with open(self.pfad, "wb") as f:
+                f.write(self.header_bytes())
+
+        if self.bits == 8:
+            tiles_feld = ("tiles", TILE_DTYPE, (self.hoehe, self.breite))
+        else:
+            tiles_feld = ("tiles", "u1", (self.gepackte_bytes(),))
+        self.record_dtype = np.dtype([tiles_feld, ("fitness", "<f4"), ("generation", "<i4")])
+
+    def header_bytes(self) -> bytes:
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header["magic"] = ARCHIV_MAGIC
+        header["version"] = ARCHIV_VERSION
+        header["bits"] = self.bits
+        header["breite"] = self.breite
+        header["hoehe"] = self.hoehe
+        header["anzahl"] = self.anzahl
+        return header.tobytes().ljust(HEADER_GROESSE, b"\0")
+
+    def gepackte_bytes(self) -> int:
+        return (self.hoehe * self.breite * TILE_BITS + 7) // 8
+
+    def __len__(self) -> int:
+        return self.anzahl
+
+    def packe(self, level: np.ndarray) -> np.ndarray:
+        # (N, hoehe, breite) -> (N, gepackte_bytes), die unteren 3 Bit jedes Tiles hintereinander
+        flach = level.reshape(len(level), -1).astype(np.uint8)
+        bits = np.unpackbits(flach[..., None], axis=-1)[..., 8 - TILE_BITS:]
+        return np.packbits(bits.reshape(len(level), -1), axis=-1)
+
+    def entpacke(self, gepackt: np.ndarray) -> np.ndarray:
+        anzahl_bits = self.hoehe * self.breite * TILE_BITS
+        bits = np.unpackbits(gepackt, axis=-1, count=anzahl_bits).reshape(len(gepackt), -1, TILE_BITS)
+        werte = bits @ (1 << np.arange(TILE_BITS - 1, -1, -1, dtype=np.uint8))
+        return werte.astype(TILE_DTYPE).reshape(len(gepackt), self.hoehe, self.breite)
+
+    def anhaengen(self, level: np.ndarray, fitness: Optional[Sequence[float]] = None,
+                  generation: Union[int, Sequence[int]] = -1) -> None:
+        # level: (hoehe, breite) oder (N, hoehe, breite), fitness fehlt -> NaN
+        level = np.asarray(level)
+        if level.ndim == 2:
+            level = level[None]
+        if level.shape[1:] != (self.hoehe, self.breite):
+            raise ValueError(f"Level hat Form {level.shape[1:]}, Archiv erwartet {(self.hoehe, self.breite)}")
+
+        records = np.zeros(len(level), dtype=self.record_dtype)
+        records["tiles"] = level if self.bits == 8 else self.packe(level)
+        records["fitness"] = np.nan if fitness is None else fitness
+        records["generation"] = generation
+
+        # erst die Records, dann die Anzahl im Header, so bleibt das Archiv bei einem Abbruch lesbar
+        with open(self.pfad, "r+b") as f:
+            f.seek(HEADER_GROESSE + self.anzahl * self.record_dtype.itemsize)
+            f.write(records.tobytes())
+            f.truncate()
+            self.anzahl += len(level)
+            f.seek(0)
+            f.write(self.header_bytes())
+
+    def records(self) -> np.ndarray:
+        # alle Records als memmap, es wird nur gelesen was auch angefasst wird
+        if self.anzahl == 0:
+            return np.zeros(0, dtype=self.record_dtype)
+        return np.memmap(self.pfad, dtype=self.record_dtype, mode="r", offset=HEADER_GROESSE, shape=(self.anzahl,))
+
+    def __getitem__(self, index) -> np.ndarray:
+        # archiv[i] -> (hoehe, breite), archiv[a:b] oder archiv[[i, j]] -> (N, hoehe, breite)
+        tiles = self.records()["tiles"][index]
+        if self.bits == 8:
+            return np.array(tiles)
+        if tiles.ndim == 1:
+            return self.entpacke(tiles[None])[0]
+        return self.entpacke(np.asarray(tiles))
+
+    @property
+    def fitness(self) -> np.ndarray:
+        return self.records()["fitness"]
+
+    @property
+    def generation(self) -> np.ndarray:
+        return self.records()["generation"]
@@ -1,7 +1,10 @@
-from typing import Optional, List
+from typing import Optional, List, Tuple, Iterable, Union
+from abc import ABC, abstractmethod
 import heapq
-from grid import Grid
-from physics import PhysikEngine, Position, Bewegung, BewegungTyp
+import numpy as np
+from grid import Grid, START, ZIEL
+from physics import PhysikEngine, BewegungsGraph, Position, Bewegung, BewegungTyp, BEWEGUNGS_TYPEN, berechne_bewegungen
+from physics import PhysikKonfig, STANDARD_PHYSIK
 
 
 class Pfad:
@@ -20,17 +23,23 @@ class Pfad:
 class ANode:
 
     def __init__(self, position: Position, g_kosten: float, h_kosten: float, parent: Optional['ANode'] = None,
-                 bewegung: Optional[Bewegung] = None):
+                 bewegung: Optional[Bewegung] = None, tiefe_zuerst: bool = False):
         self.position = position
         self.g_kosten = g_kosten
         self.h_kosten = h_kosten
         self.f_kosten = g_kosten + h_kosten
         self.parent = parent
         self.bewegung = bewegung
+        self.tiefe = parent.tiefe + 1 if parent is not None else 0
+        # wird vom Startknoten an alle Nachfolger weitergegeben
+        self.tiefe_zuerst = parent.tiefe_zuerst if parent is not None else tiefe_zuerst
 
     def __lt__(self, other):
         # fuer A*
-        return self.f_kosten < other.f_kosten
+        if self.f_kosten != other.f_kosten or not self.tiefe_zuerst:
+            return self.f_kosten < other.f_kosten
+        # optional: bei gleichen f Kosten gewinnt der tiefste Knoten im Suchbaum (Schritt 8 bei Nilsson)
+        return self.tiefe > other.tiefe
 
     def __eq__(self, other):
         if not isinstance(other, ANode):
@@ -41,6 +50,85 @@ class ANode:
         return f"ANode({self.position}, f={self.f_kosten:.1f})"
 
 
+class Heuristik(ABC):
+    # Schnittstelle fuer die A* Heuristik: geschaetzte Restkosten bis zum Ziel fuer alle Zellen (H, W) auf einmal
+    name = "basis"
+
+    @abstractmethod
+    def feld(self, autoplayer: 'Autoplayer', ziel: Position) -> np.ndarray:
+        pass
+
+
+class ManhattanHeuristik(Heuristik):
+    # Hoehe zaehlt wie Laufen mit Kosten 1, nicht zulaessig da ein Sprung bis zu 7 Felder fuer SPRINGKOSTEN schafft
+    name = "manhattan"
+
+    def feld(self, autoplayer: 'Autoplayer', ziel: Position) -> np.ndarray:
+        y, x = np.indices((autoplayer.grid.hoehe, autoplayer.grid.breite))
+        return np.abs(x - ziel.x) + np.abs(y - ziel.y)
+
+
+class PlattformerHeuristik(Heuristik):
+    # zulaessig: nach oben geht es nur mit Spruengen (hoechstens sprung_hoehe pro Sprung), jeder dieser Spruenge
+    # schafft hoechstens sprung_weite Felder zur Seite, der Rest kostet mindestens min_kosten_pro_feld
+    name = "plattformer"
+
+    def feld(self, autoplayer: 'Autoplayer', ziel: Position) -> np.ndarray:
+        konfig = autoplayer.konfig
+        y, x = np.indices((autoplayer.grid.hoehe, autoplayer.grid.breite))
+        spruenge = np.ceil(np.maximum(y - ziel.y, 0) / konfig.sprung_hoehe)
+        rest = np.maximum(np.abs(x - ziel.x) - spruenge * konfig.sprung_weite, 0)
+        return spruenge * konfig.springkosten + rest * konfig.min_kosten_pro_feld()
+
+
+class ZielDistanzHeuristik(Heuristik):
+    # exakte Restkosten aus dem Rueckwaerts-Dijkstra vom Ziel, braucht den kompilierten Graphen
+    name = "ziel_distanz"
+
+    def feld(self, autoplayer: 'Autoplayer', ziel: Position) -> np.ndarray:
+        return autoplayer.ziel_distanz_feld(ziel)
+
+
+HEURISTIKEN = {h.name: h for h in (ManhattanHeuristik, PlattformerHeuristik, ZielDistanzHeuristik)}
+
+
+class SuchPuffer:
+    # Arbeitsspeicher fuer finde_pfad_index, der ueber viele Suchen und Level wiederverwendet wird
+    # statt die Listen vor jeder Suche zu leeren bekommt jede Suche einen neuen Stempel,
+    # ein Eintrag gilt nur wenn sein Stempel der aktuelle ist
+    # wiederverwendet wird nur der Zustand der Suche, der Bewegungsgraph wird pro Level neu gebaut (PhysikEngine.kompiliere)
+    def __init__(self, anzahl: int = 0):
+        self.anzahl = 0
+        self.stempel = 0
+        self.g_kosten: List[float] = []
+        self.vorgaenger_kante: List[int] = []
+        self.tiefe: List[int] = []
+        # Stempel der Suche, in der g_kosten/vorgaenger_kante/tiefe gesetzt wurden
+        self.gesehen: List[int] = []
+        # Stempel der Suche, in der die Zelle geschlossen wurde
+        self.geschlossen: List[int] = []
+        self.open_list: List[Tuple[float, int, int, int]] = []
+        self.reserviere(anzahl)
+
+    def reserviere(self, anzahl: int) -> None:
+        # waechst nur, kleinere Grids benutzen einfach den Anfang der Listen
+        fehlend = anzahl - self.anzahl
+        if fehlend <= 0:
+            return
+        self.g_kosten.extend([float('inf')] * fehlend)
+        self.vorgaenger_kante.extend([-1] * fehlend)
+        self.tiefe.extend([0] * fehlend)
+        self.gesehen.extend([0] * fehlend)
+        self.geschlossen.extend([0] * fehlend)
+        self.anzahl = anzahl
+
+    def neue_suche(self, anzahl: int) -> int:
+        self.reserviere(anzahl)
+        self.open_list.clear()
+        self.stempel += 1
+        return self.stempel
+
+
 class Autoplayer:
     """A* Algorithm
     1. Create a search graph G, consisting only of the start node n₀. Put n₀ on a list called OPEN.
@@ -56,15 +144,62 @@ class Autoplayer:
     9. Go to step 3.
     von Nils J.Nilsson - Artificial Intelligence A new synthesis"""
 
-    def __init__(self, grid: Grid):
+    def __init__(self, grid: Grid, kompiliert: bool = False, heuristik: Union[str, Heuristik] = "manhattan",
+                 konfig: PhysikKonfig = STANDARD_PHYSIK, puffer: Optional[SuchPuffer] = None,
+                 tiefe_zuerst: bool = False):
         self.grid = grid
-        self.physik = PhysikEngine(grid)
+        self.konfig = konfig
+        self.physik = PhysikEngine(grid, konfig)
+        # heuristik: Name aus HEURISTIKEN oder eine eigene Heuristik Instanz
+        if isinstance(heuristik, str):
+            if heuristik not in HEURISTIKEN:
+                raise ValueError(f"Unbekannte Heuristik: {heuristik}")
+            heuristik = HEURISTIKEN[heuristik]()
+        self.heuristik = heuristik
+        # tiefe_zuerst: gleiche f Kosten nach Tiefe im Suchbaum statt nach Einfuegereihenfolge aufloesen (Schritt 8),
+        # mit der nicht zulaessigen Manhattan Heuristik kann das einen anderen Pfad und damit andere Fitness ergeben
+        self.tiefe_zuerst = tiefe_zuerst
+        # kompiliert: alle Bewegungen werden einmal vorberechnet anstatt bei jeder Expansion neu
+        self.kompiliert = kompiliert or isinstance(heuristik, ZielDistanzHeuristik)
+        self.graph = self.physik.kompiliere() if self.kompiliert else None
+        # Arbeitsspeicher der Index Suche, kann mit anderen Autoplayern geteilt werden
+        self.puffer = puffer
+        # Felder gelten fuer ein Ziel und eine Grid Version
+        self.distanz_feld: Optional[np.ndarray] = None
+        self.distanz_ziel: Optional[Tuple[Position, int]] = None
+        self.heuristik_feld: Optional[np.ndarray] = None
+        self.heuristik_ziel: Optional[Tuple[Position, int]] = None
 
         self.letzter_pfad: Optional[Pfad] = None
         self.anzahl_evaluierte_nodes = 0
         self.anzahl_pfadsuchen = 0
+        self.anzahl_wiederverwendet = 0
+        self.anzahl_repariert = 0
+
+    def binde(self, grid: Grid) -> 'Autoplayer':
+        # denselben Autoplayer (Engine, Heuristik, Puffer) fuer ein neues Level benutzen, verhaelt sich wie ein neuer
+        self.grid = grid
+        self.physik.binde(grid)
+        self.graph = self.physik.kompiliere() if self.kompiliert else None
+        self.distanz_feld = None
+        self.distanz_ziel = None
+        self.heuristik_feld = None
+        self.heuristik_ziel = None
+
+        self.letzter_pfad = None
+        self.anzahl_evaluierte_nodes = 0
+        self.anzahl_pfadsuchen = 0
+        self.anzahl_wiederverwendet = 0
+        self.anzahl_repariert = 0
+        return self
+
+    def ist_level_loesbar(self, eltern_pfad: Optional[Pfad] = None,
+                          geaenderte_zellen: Optional[Iterable[Tuple[int, int]]] = None) -> bool:
+        # mit eltern_pfad und geaenderten Zellen (x, y) wird inkrementell geloest, siehe loese_inkrementell
+        if eltern_pfad is not None:
+            pfad = self.loese_inkrementell(eltern_pfad, geaenderte_zellen or [])
+            return not pfad.ist_leer()
 
-    def ist_level_loesbar(self) -> bool:
         start_pos = self.grid.get_start()
         ziel_pos = self.grid.get_ziel()
 
@@ -74,9 +209,128 @@ class Autoplayer:
         start_pos = Position(start_pos[0], start_pos[1])
         ziel_pos = Position(ziel_pos[0], ziel_pos[1])
 
-        pfad = self.finde_pfad(start_pos, ziel_pos)
+        pfad = self.suche(start_pos, ziel_pos)
         return not pfad.ist_leer()
 
+    def ziel_distanz_feld(self, ziel: Optional[Position] = None) -> np.ndarray:
+        # Restkosten bis zum Ziel fuer jede Zelle (H, W), wird pro Ziel nur einmal berechnet
+        if ziel is None:
+            ziel_pos = self.grid.get_ziel()
+            if ziel_pos is None:
+                return np.full((self.grid.hoehe, self.grid.breite), float('inf'))
+            ziel = Position(ziel_pos[0], ziel_pos[1])
+
+        if self.distanz_feld is None or self.distanz_ziel != (ziel, self.grid.version):
+            graph = self.physik.kompiliere()
+            self.distanz_feld = graph.ziel_distanzen(graph.index(ziel.x, ziel.y))
+            self.distanz_ziel = (ziel, self.grid.version)
+        return self.distanz_feld
+
+    def heuristik_werte(self, ziel: Position) -> np.ndarray:
+        # Feld der Heuristik wird pro Ziel nur einmal berechnet
+        if self.heuristik_feld is None or self.heuristik_ziel != (ziel, self.grid.version):
+            self.heuristik_feld = self.heuristik.feld(self, ziel)
+            self.heuristik_ziel = (ziel, self.grid.version)
+        return self.heuristik_feld
+
+    def schaetze(self, position: Position, ziel: Position) -> float:
+        return self.heuristik_werte(ziel)[position.y, position.x].item()
+
+    def suche(self, start: Position, ziel: Position) -> Pfad:
+        # kompiliert wird die Index Suche verwendet, sonst die normale A* Suche
+        if self.graph is not None:
+            return self.finde_pfad_index(start, ziel)
+        return self.finde_pfad(start, ziel)
+
+    def loese_inkrementell(self, eltern_pfad: Pfad, geaenderte_zellen: Iterable[Tuple[int, int]]) -> Pfad:
+        # nach einer Mutation: beruehrt keine geaenderte Zelle den Pfad des Elternteils (Positionen, Kopffreiheit,
+        # Boden unter Landungen), ist der Pfad weiterhin gueltig und wird mit seinen Kosten uebernommen.
+        # Sonst wird der gueltige Anfang behalten und nur ab der ersten betroffenen Bewegung neu gesucht.
+        # Kuerzere Wege, die erst durch die Aenderung entstehen, werden dabei nicht gesucht
+        start_pos = self.grid.get_start()
+        ziel_pos = self.grid.get_ziel()
+        if start_pos is None or ziel_pos is None:
+            self.letzter_pfad = Pfad([], [])
+            return self.letzter_pfad
+
+        start = Position(start_pos[0], start_pos[1])
+        ziel = Position(ziel_pos[0], ziel_pos[1])
+
+        if eltern_pfad.ist_leer() or eltern_pfad.positionen[0] != start or eltern_pfad.positionen[-1] != ziel:
+            self.letzter_pfad = self.suche(start, ziel)
+            return self.letzter_pfad
+
+        geaendert = set(geaenderte_zellen)
+        betroffen = len(eltern_pfad.bewegungen)
+        for i, bewegung in enumerate(eltern_pfad.bewegungen):
+            if not geaendert.isdisjoint(self.physik.abhaengige_zellen(bewegung)):
+                betroffen = i
+                break
+
+        if betroffen == len(eltern_pfad.bewegungen):
+            self.anzahl_wiederverwendet += 1
+            self.anzahl_evaluierte_nodes = 0
+            self.letzter_pfad = eltern_pfad
+            return eltern_pfad
+
+        # lokale Reparatur ab der letzten noch gueltigen Position
+        self.anzahl_repariert += 1
+        rest = self.suche(eltern_pfad.positionen[betroffen], ziel)
+        if rest.ist_leer() and betroffen > 0:
+            # vom Zwischenpunkt aus nicht loesbar, das Level kann aber ueber einen anderen Weg loesbar sein
+            pfad = self.suche(start, ziel)
+        elif rest.ist_leer():
+            # bei betroffen == 0 war die Reparatur schon die volle Suche ab dem Start
+            pfad = rest
+        else:
+            pfad = Pfad(eltern_pfad.positionen[:betroffen] + rest.positionen,
+                        eltern_pfad.bewegungen[:betroffen] + rest.bewegungen)
+        self.letzter_pfad = pfad
+        return pfad
+
+    @staticmethod
+    def loesbar_batch(stapel: np.ndarray, konfig: PhysikKonfig = STANDARD_PHYSIK) -> Tuple[np.ndarray, np.ndarray]:
+        # Loesbarkeit fuer einen ganzen Stapel (P, H, W) gleichzeitig: Breitensuche, bei der die Front aller Level
+        # mit den Lauf-/Sprung-/Fallmasken auf einmal verschoben wird. Kein A*, keine Position Objekte
+        # Rueckgabe: loesbar (P,) und minimale Anzahl an Bewegungen bis zum Ziel (P,), -1 wenn unloesbar
+        anzahl = stapel.shape[0]
+        hoehe, breite = stapel.shape[-2:]
+        flach = stapel.reshape(anzahl, hoehe * breite)
+
+        def erstes(tile: int) -> np.ndarray:
+            # wie get_start/get_ziel: nur das erste Vorkommen zaehlt
+            maske = flach == tile
+            return (maske & (np.cumsum(maske, axis=1) == 1)).reshape(stapel.shape)
+
+        start = erstes(START)
+        ziel = erstes(ZIEL)
+        # Verschiebungen ab Grid Groesse fuehren immer aus dem Grid (Maske ist leer) und wuerden die Slices unten sprengen
+        spruenge = [(dx, dy, maske) for _, _, eintraege in berechne_bewegungen(stapel, konfig)
+                    for dx, dy, maske in eintraege if abs(dx) < breite and abs(dy) < hoehe]
+
+        schritte = np.full(anzahl, -1, dtype=np.int64)
+        erreicht = start.copy()
+        front = start
+        schritt = 0
+        while front.any():
+            schritt += 1
+            neu = np.zeros_like(front)
+            for dx, dy, maske in spruenge:
+                # Front um (dx, dy) verschieben, was aus dem Grid faellt verschwindet
+                quelle = front & maske
+                neu[..., max(dy, 0):hoehe + min(dy, 0), max(dx, 0):breite + min(dx, 0)] |= \
+                    quelle[..., max(-dy, 0):hoehe - max(dy, 0), max(-dx, 0):breite - max(dx, 0)]
+            neu &= ~erreicht
+            erreicht |= neu
+
+            gefunden = (neu & ziel).any(axis=(1, 2))
+            schritte[gefunden] = schritt
+            # Level mit gefundenem Ziel muessen nicht weiter gesucht werden
+            neu[gefunden] = False
+            front = neu
+
+        return schritte >= 0, schritte
+
     def finde_pfad(self, start: Position, ziel: Position, max_iterationen: int = 10000) -> Pfad:
         self.anzahl_pfadsuchen += 1
         self.anzahl_evaluierte_nodes = 0
@@ -90,7 +344,7 @@ class Autoplayer:
 
         g_kosten_map = {start: 0}
 
-        start_node = ANode(position=start, g_kosten=0, h_kosten=start.manhattan_distanz_zu(ziel))
+        start_node = ANode(position=start, g_kosten=0, h_kosten=self.schaetze(start, ziel), tiefe_zuerst=self.tiefe_zuerst)
         heapq.heappush(open_list, start_node)
 
         iterationen = 0
@@ -126,15 +380,120 @@ class Autoplayer:
 
         return Pfad([], [])
 
+    def finde_pfad_index(self, start: Position, ziel: Position, max_iterationen: int = 10000) -> Pfad:
+        # gleiche Suche wie finde_pfad, aber auf Zellindizes y * breite + x des kompilierten Graphen
+        # keine ANode/Position Objekte waehrend der Suche, der Heap enthaelt nur (f, rang, tie, index) Tupel
+        self.anzahl_pfadsuchen += 1
+        self.anzahl_evaluierte_nodes = 0
+
+        if start == ziel:
+            return Pfad([start], [])
+
+        graph = self.physik.kompiliere()
+        offsets, ziele, kosten, _ = graph.listen()
+        breite = graph.breite
+        anzahl = breite * graph.hoehe
+
+        # wiederverwendete Listen aus dem SuchPuffer anstelle von g_kosten_map und closed_set
+        if self.puffer is None:
+            self.puffer = SuchPuffer(anzahl)
+        puffer = self.puffer
+        stempel = puffer.neue_suche(anzahl)
+        g_kosten = puffer.g_kosten
+        vorgaenger_kante = puffer.vorgaenger_kante
+        tiefe = puffer.tiefe
+        gesehen = puffer.gesehen
+        geschlossen = puffer.geschlossen
+
+        start_index = graph.index(start.x, start.y)
+        ziel_index = graph.index(ziel.x, ziel.y)
+        g_kosten[start_index] = 0
+        tiefe[start_index] = 0
+        gesehen[start_index] = stempel
+
+        # h fuer alle Zellen auf einmal, Zellen ohne Weg zum Ziel (h = inf) kommen nie in die open_list
+        h_liste = self.heuristik_werte(ziel).ravel().tolist()
+        if h_liste[start_index] == float('inf'):
+            return Pfad([], [])
+
+        # bei gleichen f Kosten entscheidet die Einfuegereihenfolge (tie), mit tiefe_zuerst vorher der tiefste Knoten
+        # (rang = -tiefe, sonst immer 0)
+        tiefe_zuerst = self.tiefe_zuerst
+        open_list = puffer.open_list
+        open_list.append((h_liste[start_index], 0, 0, start_index))
+        tie = 1
+
+        iterationen = 0
+        while open_list and iterationen < max_iterationen:
+            iterationen += 1
+            self.anzahl_evaluierte_nodes += 1
+
+            _, _, _, current = heapq.heappop(open_list)
+
+            if geschlossen[current] == stempel:
+                continue
+
+            if current == ziel_index:
+                pfad = self.rekonstruiere_pfad_index(graph, start_index, ziel_index, vorgaenger_kante)
+                self.letzter_pfad = pfad
+                return pfad
+
+            geschlossen[current] = stempel
+
+            current_g = g_kosten[current]
+            naechste_tiefe = tiefe[current] + 1
+            for kante in range(offsets[current], offsets[current + 1]):
+                nachbar = ziele[kante]
+                if geschlossen[nachbar] == stempel:
+                    continue
+
+                neue_g_kosten = current_g + kosten[kante]
+                if (gesehen[nachbar] != stempel or neue_g_kosten < g_kosten[nachbar]) and h_liste[nachbar] != float('inf'):
+                    gesehen[nachbar] = stempel
+                    g_kosten[nachbar] = neue_g_kosten
+                    vorgaenger_kante[nachbar] = kante
+                    tiefe[nachbar] = naechste_tiefe
+                    rang = -naechste_tiefe if tiefe_zuerst else 0
+                    heapq.heappush(open_list, (neue_g_kosten + h_liste[nachbar], rang, tie, nachbar))
+                    tie += 1
+
+        return Pfad([], [])
+
+    def rekonstruiere_pfad_index(self, graph: BewegungsGraph, start_index: int, ziel_index: int, vorgaenger_kante: List[int]) -> Pfad:
+        # erst hier werden Position und Bewegung Objekte fuer den fertigen Pfad erzeugt
+        offsets, ziele, kosten, typen = graph.listen()
+
+        kanten = []
+        current = ziel_index
+        while current != start_index:
+            kante = vorgaenger_kante[current]
+            kanten.append(kante)
+            # Startzelle der Kante ist die Zeile im CSR Array, in der die Kante liegt
+            current = int(np.searchsorted(graph.offsets, kante, side='right')) - 1
+        kanten.reverse()
+
+        positionen = [Position(*graph.koordinaten(start_index))]
+        bewegungen = []
+        for kante in kanten:
+            ziel_pos = Position(*graph.koordinaten(ziele[kante]))
+            bewegungen.append(Bewegung(start=positionen[-1], ziel=ziel_pos, typ=BEWEGUNGS_TYPEN[typen[kante]],
+                                       kosten=kosten[kante]))
+            positionen.append(ziel_pos)
+
+        return Pfad(positionen, bewegungen)
+
     def finde_nachbar_nodes(self, current: ANode, ziel: Position) -> List[ANode]:
         nachbar_nodes = []
 
-        moegliche_bewegungen = self.physik.finde_alle_nachbarn(current.position)
+        if self.graph is not None:
+            moegliche_bewegungen = self.physik.kompiliere().bewegungen(current.position)
+        else:
+            moegliche_bewegungen = self.physik.finde_alle_nachbarn(current.position)
 
         for bewegung in moegliche_bewegungen:
             neue_g_kosten = current.g_kosten + bewegung.kosten
 
-            h_kosten = bewegung.ziel.manhattan_distanz_zu(ziel)
+            h_kosten = self.schaetze(bewegung.ziel, ziel)
 
             nachbar = ANode(position=bewegung.ziel, g_kosten=neue_g_kosten, h_kosten=h_kosten, parent=current,
                             bewegung=bewegung)
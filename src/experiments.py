@@ -7,7 +7,9 @@ import numpy as np
 
 from fitness import SimpleFitness, Fitness
 from genetics import GeneticAlgorithm
-from src.grid import LevelBuilder, Grid
+from parallel import ParallelEvaluator
+from autoplayer import Autoplayer, HEURISTIKEN
+from src.grid import LevelBuilder, LevelCodec, Grid
 from src.visualizer import GridVisualizer
 
 
@@ -17,7 +19,9 @@ class Experiment:
         self.output.mkdir(exist_ok=True)
         self.all_experiments: List[Dict] = []
 
-    def execute_experiments(self, ga_config: Dict, fitness_config: Optional[Dict], generationen: int = 50, wiederholungen: int = 3, name: str = ""):
+    def execute_experiments(self, ga_config: Dict, fitness_config: Optional[Dict], generationen: int = 50, wiederholungen: int = 3, name: str = "",
+                            prozesse: int = 1):
+        # prozesse > 1: Population wird mit ParallelEvaluator auf mehreren Prozessen bewertet
         runs_ergebnisse = []
         for run in range(wiederholungen):
             ga = GeneticAlgorithm(**ga_config)
@@ -25,14 +29,21 @@ class Experiment:
                 evaluator = SimpleFitness()
             else:
                 evaluator = Fitness(**fitness_config)
-            ga.initialisiere_population()
-
-            start_zeit = time.time()
-            ga.evolution(
-                generationen=generationen,
-                fitness_evaluator=evaluator,
-                verbose=False
-            )
+            if prozesse > 1:
+                evaluator = ParallelEvaluator(evaluator, prozesse)
+            # ab hier laufen die Prozesse, auch ein Fehler in der Initialisierung muss sie beenden
+            try:
+                ga.initialisiere_population(evaluator)
+
+                start_zeit = time.time()
+                ga.evolution(
+                    generationen=generationen,
+                    fitness_evaluator=evaluator,
+                    verbose=False
+                )
+            finally:
+                if prozesse > 1:
+                    evaluator.schliesse()
             end_zeit = time.time()
 
             konvergenz = self.analysiere_konvergenz(ga.beste_fitness_generation)
@@ -352,22 +363,7 @@ class Experiment:
             filepath = os.path.join(self.output, f"bestes_level_{name}.txt")
             level = exp['bestes_level']
             best_level = LevelBuilder.matrix_grid(level)
-            with open(filepath, 'w') as f:
-                f.write(f"Beste Fitness: {exp['beste_fitness_max']:.2f}\n\n")
-                for y in range(best_level.hoehe):
-                    for x in range(best_level.breite):
-                        tile = best_level.get_tile(x, y)
-                        if tile == 0:
-                            f.write('.')
-                        elif tile == 1:
-                            f.write('#')
-                        elif tile == 2:
-                            f.write('=')
-                        elif tile == 3:
-                            f.write('S')
-                        elif tile == 4:
-                            f.write('Z')
-                    f.write('\n')
+            LevelCodec.speichere(filepath, best_level.tiles, f"Beste Fitness: {exp['beste_fitness_max']:.2f}")
 
         print(f"✅ Beste Level gespeichert in: {self.output}")
         return best_level
@@ -379,26 +375,49 @@ class Experiment:
             for j in range(len(level_list)):
                 filepath = os.path.join(self.output, f"zwischen_level_{name}_{j}.txt")
                 level = level_list[j]
-                zwischen_level = LevelBuilder.matrix_grid(level)
-                with open(filepath, 'w') as f:
-                    f.write(f"Beste Fitness: {exp['beste_fitness_max']:.2f}\n\n")
-                    for y in range(zwischen_level.hoehe):
-                        for x in range(zwischen_level.breite):
-                            tile = zwischen_level.get_tile(x, y)
-                            if tile == 0:
-                                f.write('.')
-                            elif tile == 1:
-                                f.write('#')
-                            elif tile == 2:
-                                f.write('=')
-                            elif tile == 3:
-                                f.write('S')
-                            elif tile == 4:
-                                f.write('Z')
-                        f.write('\n')
+                LevelCodec.speichere(filepath, level, f"Beste Fitness: {exp['beste_fitness_max']:.2f}")
 
         print(f"✅ Zwischen Level gespeichert in: {self.output}")
 
+    def vergleiche_heuristiken(self, level: Optional[List[Grid]] = None, anzahl_level: int = 200,
+                               filename: str = "heuristik_vergleich.csv") -> Dict:
+        # Anzahl expandierter Nodes (anzahl_evaluierte_nodes) pro Heuristik auf denselben Leveln
+        if level is None:
+            level = [LevelBuilder.zufalls_level() for _ in range(anzahl_level)]
+
+        ergebnisse = {}
+        for name in HEURISTIKEN:
+            nodes = []
+            kosten = []
+            for grid in level:
+                autoplayer = Autoplayer(grid, kompiliert=True, heuristik=name)
+                if autoplayer.ist_level_loesbar():
+                    nodes.append(autoplayer.anzahl_evaluierte_nodes)
+                    kosten.append(sum(b.kosten for b in autoplayer.letzter_pfad.bewegungen))
+            ergebnisse[name] = {
+                'loesbare_level': len(nodes),
+                'nodes_summe': int(np.sum(nodes)),
+                'nodes_mittel': float(np.mean(nodes)) if nodes else 0.0,
+                'pfadkosten_mittel': float(np.mean(kosten)) if kosten else 0.0
+            }
+
+        filepath = self.output / filename
+        with open(filepath, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Heuristik', 'Loesbare_Level', 'Nodes_Summe', 'Nodes_Mittel', 'Pfadkosten_Mittel'])
+            for name, e in ergebnisse.items():
+                writer.writerow([name, e['loesbare_level'], e['nodes_summe'], f"{e['nodes_mittel']:.2f}",
+                                 f"{e['pfadkosten_mittel']:.2f}"])
+
+        print(f"\n{'Heuristik':<15} {'Loesbar':>8} {'Nodes':>10} {'Nodes/Level':>12} {'Kosten':>8}")
+        print("-" * 57)
+        for name, e in ergebnisse.items():
+            print(f"{name:<15} {e['loesbare_level']:>8} {e['nodes_summe']:>10} "
+                  f"{e['nodes_mittel']:>12.2f} {e['pfadkosten_mittel']:>8.2f}")
+        print(f"✅ Heuristik Vergleich exportiert: {filepath}")
+
+        return ergebnisse
+
     def drucke_zusammenfassung(self):
         """Druckt Zusammenfassung aller Experimente."""
         print(f"\n{'=' * 70}")
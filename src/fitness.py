@@ -1,56 +1,204 @@
-from grid import Grid, PLATTFORM
+from collections import OrderedDict
+from grid import Grid, PLATTFORM, BODEN, TILE_DTYPE
 from autoplayer import Autoplayer, Pfad
-from typing import Dict
+from typing import Dict, Optional, List, Tuple, Hashable
 
-from src.physics import Position
+import numpy as np
+
+from physics import LoesbarkeitsValidator, PhysikKonfig, STANDARD_PHYSIK
+
+# Fitness fuer unloesbare Level
+UNLOESBAR_FITNESS = -50
+# Anzahl Level die sich ein Evaluator merkt
+CACHE_GROESSE = 10000
+# Ergebnis von berechne_fitness_batch, ein Eintrag pro Level
+FITNESS_DTYPE = np.dtype([("fitness", "f8"), ("loesbar", "?"), ("pfad_laenge", "i4"), ("anzahl_spruenge", "i4")])
+
+
+class FitnessCache:
+    # LRU Cache fuer schon bewertete Level: (Konfiguration, Form, Tiles als Bytes) -> (fitness, pfad)
+    # Elite, unveraenderte Kinder und Duplikate muessen so nicht noch einmal geloest werden
+    # der Schluessel kennt nur den Inhalt, gespeichert werden deshalb nur Ergebnisse voller Pfadsuchen
+    def __init__(self, max_groesse: int = CACHE_GROESSE):
+        self.max_groesse = max_groesse
+        self.eintraege: OrderedDict = OrderedDict()
+        self.treffer = 0
+        self.fehlschlaege = 0
+
+    @staticmethod
+    def schluessel(grid: Grid, konfiguration: Hashable) -> Tuple:
+        tiles = np.ascontiguousarray(grid.tiles, dtype=TILE_DTYPE)
+        return konfiguration, tiles.shape, tiles.tobytes()
+
+    def hole(self, schluessel: Tuple) -> Optional[Tuple[float, Optional[Pfad]]]:
+        eintrag = self.eintraege.get(schluessel)
+        if eintrag is None:
+            self.fehlschlaege += 1
+            return None
+        self.treffer += 1
+        self.eintraege.move_to_end(schluessel)
+        return eintrag
+
+    def speichere(self, schluessel: Tuple, fitness: float, pfad: Optional[Pfad]) -> None:
+        if self.max_groesse <= 0:
+            return
+        self.eintraege[schluessel] = (fitness, pfad)
+        self.eintraege.move_to_end(schluessel)
+        # am laengsten nicht benutzter Eintrag fliegt raus
+        while len(self.eintraege) > self.max_groesse:
+            self.eintraege.popitem(last=False)
+
+    def get_statistiken(self) -> Dict:
+        anfragen = self.treffer + self.fehlschlaege
+        return {'cache_treffer': self.treffer, 'cache_fehlschlaege': self.fehlschlaege,
+                'cache_trefferquote': self.treffer / anfragen if anfragen else 0.0}
 
 
 class SimpleFitness:
 
-    def __init__(self):
+    def __init__(self, konfig: PhysikKonfig = STANDARD_PHYSIK, cache_groesse: int = CACHE_GROESSE):
+        # Bewegungsregeln fuer Autoplayer und Vorfilter
+        self.konfig = konfig
+        self.cache = FitnessCache(cache_groesse)
+        # ein Autoplayer fuer alle Level, siehe loeser
+        self.autoplayer: Optional[Autoplayer] = None
         self.anzahl_level = 0
         self.anzahl_loesbar = 0
+        self.anzahl_wiederverwendet = 0
+        # sicher unloesbare Level werden ohne Pfadsuche aussortiert
+        self.vorfilter = LoesbarkeitsValidator(konfig)
 
-    def berechne_fitness(self, grid: Grid) -> float:
-        # simple Fitness wo einfach nur Loesbarkeit + Schwierigkeit geprüft wird, wobei Schwierigkeit nur die Anzahl an Spruengen ist
+    def berechne_fitness(self, grid: Grid, loesbar: Optional[bool] = None, eltern_pfad: Optional[Pfad] = None,
+                         geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> float:
+        # loesbar: schon bekannte Loesbarkeit (z.B. aus Autoplayer.loesbar_batch), bei False wird keine Pfadsuche gemacht
+        # eltern_pfad/geaenderte_zellen: Pfad des Elternteils wird wiederverwendet, siehe Autoplayer.loese_inkrementell
+        # der Pfad selbst kommt aus bewerte_level
+        fitness, pfad = self.bewerte_level(grid, loesbar, eltern_pfad, geaenderte_zellen)
         self.anzahl_level += 1
+        if pfad is not None:
+            self.anzahl_loesbar += 1
+        return fitness
+
+    def berechne_fitness_batch(self, population: np.ndarray, eltern_pfade: Optional[List[Optional[Pfad]]] = None,
+                               geaenderte_zellen: Optional[List[Optional[List[Tuple[int, int]]]]] = None) -> np.ndarray:
+        # Rueckgabe ist ein strukturiertes Array mit FITNESS_DTYPE, die Pfade gibt es ueber bewerte_population
+        ergebnis, _ = self.bewerte_population(population, eltern_pfade, geaenderte_zellen)
+        return ergebnis
+
+    def bewerte_population(self, population: np.ndarray, eltern_pfade: Optional[List[Optional[Pfad]]] = None,
+                           geaenderte_zellen: Optional[List[Optional[List[Tuple[int, int]]]]] = None
+                           ) -> Tuple[np.ndarray, List[Optional[Pfad]]]:
+        # ganze Population (P, H, W) auf einmal: unloesbare Level werden gemeinsam mit loesbar_batch aussortiert,
+        # nur die loesbaren werden einzeln geloest. Rueckgabe: FITNESS_DTYPE Array und Pfad pro Level (None wenn unloesbar)
+        anzahl = len(population)
+        ergebnis = np.zeros(anzahl, dtype=FITNESS_DTYPE)
+        ergebnis["fitness"] = UNLOESBAR_FITNESS
+        pfade: List[Optional[Pfad]] = [None] * anzahl
+
+        loesbar, _ = Autoplayer.loesbar_batch(population, self.konfig)
+        for i in np.flatnonzero(loesbar).tolist():
+            eltern_pfad = eltern_pfade[i] if eltern_pfade is not None else None
+            zellen = geaenderte_zellen[i] if geaenderte_zellen is not None else None
+            fitness, pfad = self.bewerte_level(Grid.view(population[i]), True, eltern_pfad, zellen)
+            ergebnis[i] = (fitness, pfad is not None, pfad.laenge if pfad else 0, pfad.anzahl_spruenge if pfad else 0)
+            pfade[i] = pfad
+
+        self.anzahl_level += anzahl
+        self.anzahl_loesbar += int(np.count_nonzero(ergebnis["loesbar"]))
+        return ergebnis, pfade
+
+    def bewerte_level(self, grid: Grid, loesbar: Optional[bool] = None, eltern_pfad: Optional[Pfad] = None,
+                      geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> Tuple[float, Optional[Pfad]]:
+        # Vorfilter und Cache um bewerte herum, ohne die Zaehler anzufassen
+        if loesbar is False:
+            return UNLOESBAR_FITNESS, None
+
+        schluessel = self.cache.schluessel(grid, self.cache_konfiguration())
+        eintrag = self.cache.hole(schluessel)
+        if eintrag is not None:
+            return eintrag
+
+        if loesbar is None and self.vorfilter.pruefe(grid) is not None:
+            return UNLOESBAR_FITNESS, None
+
+        fitness, pfad = self.bewerte(grid, eltern_pfad, geaenderte_zellen)
+        # inkrementell reparierte Pfade sind nicht unbedingt optimal, der Cache enthaelt nur Ergebnisse voller Suchen,
+        # sonst haengt die Fitness eines Levels davon ab, als was es zuerst bewertet wurde
+        if eltern_pfad is None:
+            self.cache.speichere(schluessel, fitness, pfad)
+        return fitness, pfad
 
-        autoplayer = Autoplayer(grid)
-        loesbar = autoplayer.ist_level_loesbar()
+    def cache_konfiguration(self) -> Hashable:
+        # alles ausser dem Level, was die Fitness beeinflusst
+        return self.konfig
+
+    def setze_zaehler_zurueck(self) -> None:
+        # Statistik Zaehler auf 0, der Cache Inhalt bleibt (z.B. fuer Kopien des Evaluators in anderen Prozessen)
+        self.anzahl_level = 0
+        self.anzahl_loesbar = 0
+        self.anzahl_wiederverwendet = 0
+        for grund in self.vorfilter.abgelehnt:
+            self.vorfilter.abgelehnt[grund] = 0
+        self.cache.treffer = 0
+        self.cache.fehlschlaege = 0
+
+    def loeser(self, grid: Grid) -> Autoplayer:
+        # Autoplayer (Engine, Heuristik, Suchpuffer) wird nur an das neue Grid gebunden statt neu gebaut,
+        # der Bewegungsgraph haengt vom Level ab und wird fuer jedes neue Level neu kompiliert
+        if self.autoplayer is None:
+            self.autoplayer = Autoplayer(grid, kompiliert=True, konfig=self.konfig)
+        else:
+            self.autoplayer.binde(grid)
+        return self.autoplayer
+
+    def bewerte(self, grid: Grid, eltern_pfad: Optional[Pfad] = None,
+                geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> Tuple[float, Optional[Pfad]]:
+        # simple Fitness wo einfach nur Loesbarkeit + Schwierigkeit geprüft wird, wobei Schwierigkeit nur die Anzahl an Spruengen ist
+        autoplayer = self.loeser(grid)
+        loesbar = autoplayer.ist_level_loesbar(eltern_pfad, geaenderte_zellen)
+        self.anzahl_wiederverwendet += autoplayer.anzahl_wiederverwendet
         pfad = autoplayer.letzter_pfad
         statistik = autoplayer.berechne_pfad_statistiken(pfad)
         if not loesbar:
-            return -50
+            return UNLOESBAR_FITNESS, None
 
-        self.anzahl_loesbar += 1
         anzahl_spruenge = statistik["anzahl_spruenge"]
         fitness = 1000.0 + anzahl_spruenge * 10.0
 
-        return fitness
+        return fitness, pfad
 
     def get_statistiken(self) -> Dict:
         return {'anzahl_level': self.anzahl_level, 'anzahl_loesbare': self.anzahl_loesbar,
-                'loesbarkeits_rate': (self.anzahl_loesbar / self.anzahl_level)}
+                'loesbarkeits_rate': (self.anzahl_loesbar / self.anzahl_level),
+                'pfade_wiederverwendet': self.anzahl_wiederverwendet,
+                'vorfilter_abgelehnt': dict(self.vorfilter.abgelehnt),
+                **self.cache.get_statistiken()}
 
 
-class Fitness:
+class Fitness(SimpleFitness):
     def __init__(self, gewicht_loesbarkeit: float = 1000.0, gewicht_schwierigkeit: float = 3.0,
-                 gewicht_plattformen: float = 2.0):
+                 gewicht_plattformen: float = 2.0, gewicht_erreichbarkeit: float = 0.0,
+                 konfig: PhysikKonfig = STANDARD_PHYSIK, cache_groesse: int = CACHE_GROESSE):
+        super().__init__(konfig, cache_groesse)
         self.gewicht_loesbarkeit = gewicht_loesbarkeit
         self.gewicht_schwierigkeit = gewicht_schwierigkeit
         self.gewicht_plattformen = gewicht_plattformen
+        # belohnt Level, bei denen man von moeglichst vielen Plattformen aus noch ins Ziel kommt
+        self.gewicht_erreichbarkeit = gewicht_erreichbarkeit
 
-        self.anzahl_level = 0
-        self.anzahl_loesbar = 0
+    def cache_konfiguration(self) -> Hashable:
+        return (self.konfig, self.gewicht_loesbarkeit, self.gewicht_schwierigkeit, self.gewicht_plattformen,
+                self.gewicht_erreichbarkeit)
 
-    def berechne_fitness(self, grid: Grid) -> float:
-        self.anzahl_level += 1
-        autoplayer = Autoplayer(grid)
-        loesbar = autoplayer.ist_level_loesbar()
+    def bewerte(self, grid: Grid, eltern_pfad: Optional[Pfad] = None,
+                geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> Tuple[float, Optional[Pfad]]:
+        # Pfadsuche und eigentliche Fitness, bewerte_level kuemmert sich um Vorfilter und Cache
+        autoplayer = self.loeser(grid)
+        loesbar = autoplayer.ist_level_loesbar(eltern_pfad, geaenderte_zellen)
+        self.anzahl_wiederverwendet += autoplayer.anzahl_wiederverwendet
         if not loesbar:
-            return -50
+            return UNLOESBAR_FITNESS, None
 
-        self.anzahl_loesbar += 1
         pfad = autoplayer.letzter_pfad
         statistik = autoplayer.berechne_pfad_statistiken(pfad)
 
@@ -59,8 +207,10 @@ class Fitness:
         plattform_nutzung = self.berechne_plattform(grid, pfad)
 
         fitness = loesbarkeit + schwierigkeit + plattform_nutzung
+        if self.gewicht_erreichbarkeit != 0.0:
+            fitness += self.berechne_erreichbarkeit(grid, autoplayer.ziel_distanz_feld())
 
-        return fitness
+        return fitness, pfad
 
     def berechne_schwierigkeit(self, statistik: Dict) -> float:
         # Da Sprungkosten teuer ist, ist jeder Sprung auch ein Höhenunterschied des Levels -> Wenn möglich wird gelaufen, daher keine Vertikalitätscheck
@@ -73,39 +223,42 @@ class Fitness:
     def berechne_plattform(self, grid: Grid, pfad: Pfad) -> float:
         # berechne Plattformnutzung, anhand der Pfad Positionen
         # Ebenfalls die Plattform isolierung, wenn pfad nicht genutzt wird, dann die Nachbarn und schauen ob das eine PLattform ist
-        plattformen = []
-        pfad_set = set(pfad.positionen)
-        genutzte_plattformen = 0
-        isolierte_plattformen = 0
-
-        for y in range(grid.hoehe):
-            for x in range(grid.breite):
-                if grid.get_tile(x, y) == PLATTFORM:
-                    pos = Position(x, y)
-                    plattformen.append(pos)
-                    if pos in pfad_set:
-                        genutzte_plattformen += 1
-                    else:
-                        nachbarn = [(x - 1, y),
-                                    (x + 1, y),
-                                    (x, y - 1),
-                                    (x, y + 1)]
-                        hat_nachbar = any(
-                            0 <= nx < grid.breite and
-                            0 <= ny < grid.hoehe and
-                            grid.get_tile(nx, ny) == PLATTFORM
-                            for nx, ny in nachbarn
-                        )
-                        if not hat_nachbar:
-                            isolierte_plattformen += 1
-        if len(plattformen) == 0:
+        # alles als Masken ueber das ganze Grid statt Zelle fuer Zelle
+        plattformen = grid.tiles == PLATTFORM
+        anzahl_plattformen = np.count_nonzero(plattformen)
+        if anzahl_plattformen == 0:
             return 0.0
-        nutzungs_ratio = genutzte_plattformen / len(plattformen)
-        isolations_strafe = isolierte_plattformen / len(plattformen)
+
+        pfad_maske = np.zeros_like(plattformen)
+        if pfad.positionen:
+            xs = np.fromiter((p.x for p in pfad.positionen), dtype=np.intp, count=len(pfad.positionen))
+            ys = np.fromiter((p.y for p in pfad.positionen), dtype=np.intp, count=len(pfad.positionen))
+            im_grid = (xs >= 0) & (xs < grid.breite) & (ys >= 0) & (ys < grid.hoehe)
+            pfad_maske[ys[im_grid], xs[im_grid]] = True
+
+        # Plattform links, rechts, oben oder unten
+        hat_nachbar = np.zeros_like(plattformen)
+        hat_nachbar[1:] |= plattformen[:-1]
+        hat_nachbar[:-1] |= plattformen[1:]
+        hat_nachbar[:, 1:] |= plattformen[:, :-1]
+        hat_nachbar[:, :-1] |= plattformen[:, 1:]
+
+        genutzte_plattformen = np.count_nonzero(plattformen & pfad_maske)
+        isolierte_plattformen = np.count_nonzero(plattformen & ~pfad_maske & ~hat_nachbar)
+
+        nutzungs_ratio = genutzte_plattformen / anzahl_plattformen
+        isolations_strafe = isolierte_plattformen / anzahl_plattformen
         score = (nutzungs_ratio * 100.0 - isolations_strafe * 50.0)
 
         return max(0.0, score) * self.gewicht_plattformen
 
-    def get_statistiken(self) -> Dict:
-        return {'anzahl_level': self.anzahl_level, 'anzahl_loesbare': self.anzahl_loesbar,
-                'loesbarkeits_rate': (self.anzahl_loesbar / self.anzahl_level)}
+    def berechne_erreichbarkeit(self, grid: Grid, ziel_distanzen: np.ndarray) -> float:
+        # Anteil der Standplaetze auf Plattformen, von denen das Ziel noch erreichbar ist (ohne weitere Suchen)
+        plattform_darunter = np.zeros((grid.hoehe, grid.breite), dtype=bool)
+        plattform_darunter[:-1] = grid.tiles[1:] == PLATTFORM
+        standplaetze = plattform_darunter & (grid.tiles != PLATTFORM) & (grid.tiles != BODEN)
+        if not standplaetze.any():
+            return 0.0
+        anteil = np.isfinite(ziel_distanzen[standplaetze]).mean()
+
+        return float(anteil) * 100.0 * self.gewicht_erreichbarkeit
@@ -1,180 +1,275 @@
 from typing import List, Optional, Tuple, Dict
-from grid import Grid, LevelBuilder, LUFT, PLATTFORM, START, ZIEL
-from fitness import SimpleFitness
+from grid import Grid, LevelBuilder, LUFT, PLATTFORM, START, ZIEL, TILE_DTYPE
+from fitness import SimpleFitness, FITNESS_DTYPE
+from autoplayer import Pfad
+from konstruktion import LevelKonstrukteur
+from archiv import LevelArchiv
+from physics import STANDARD_PHYSIK
 
 import numpy as np
 
 PLATTFORM_WAHRSCHEINLICHKEIT = 0.15
 # StandardWert
 TOURNAMENT = 3
+# moegliche Selektionsverfahren, siehe selektiere_index_batch
+SELEKTIONEN = ("tournament", "rang", "sus")
 # Selbst ausgewählte Werte: Ein Level soll nicht zu viele Plattformen haben
 LUFT_MUTATION = 0.7
 PLATTFORM_MUTATION = 0.3
+# bis zu dieser Mutationsrate werden die Zellen direkt gezogen, darueber ist eine Zufallsmaske billiger
+DUENNE_MUTATION = 0.1
 
 
 class GeneticAlgorithm:
     # erste Paraneter values hiervon inspierert https://www.woodruff.dev/day-31-best-practices-for-tuning-genetic-algorithm-parameters/
     def __init__(self, population_size: int = 50, crossover_wahrscheinlichkeit: float = 0.7, mutation_wahrscheinlichkeit: float = 0.1, elite: int = 2,
-                 breite: int = 20, hoehe: int = 10):
+                 breite: int = 20, hoehe: int = 10, inkrementell: bool = False, konstruktiv: bool = False,
+                 selektion: str = "tournament", rng: Optional[np.random.Generator] = None):
         self.population_size = population_size
         self.crossover_wahrscheinlichkeit = crossover_wahrscheinlichkeit
         self.mutation_wahrscheinlichkeit = mutation_wahrscheinlichkeit
         self.elite = elite
         self.breite = breite
         self.hoehe = hoehe
-
-        self.population: List[np.ndarray] = []
-        self.fitnesses: List[float] = []
+        if selektion not in SELEKTIONEN:
+            raise ValueError(f"Unbekannte Selektion: {selektion}")
+        self.selektion = selektion
+        # ohne eigenen Generator wird aus np.random abgeleitet, damit np.random.seed weiterhin reproduzierbar ist
+        self.rng = rng if rng is not None else np.random.default_rng(np.random.randint(2 ** 31))
+
+        # Population als ein Tensor (population_size, hoehe, breite), jedes Individuum ist eine Zeile davon
+        self.population: np.ndarray = np.zeros((0, hoehe, breite), dtype=TILE_DTYPE)
+        self.fitnesses: np.ndarray = np.zeros(0)
+        # Fitness und Pfadstatistik pro Individuum (FITNESS_DTYPE) der letzten Bewertung
+        self.ergebnisse: np.ndarray = np.zeros(0, dtype=FITNESS_DTYPE)
         self.generation = 0
 
+        # inkrementell: Kinder ohne Crossover werden mit dem Pfad des Elternteils geloest (Autoplayer.loese_inkrementell)
+        # herkunft[i] = (index des Elternteils in der letzten Generation, geaenderte Zellen) oder None
+        self.inkrementell = inkrementell
+        # konstruktiv: Startpopulation aus LevelKonstrukteur statt reiner Zufallslevel, dann ist jedes Level loesbar
+        self.konstruktiv = konstruktiv
+        self.pfade: List[Optional[Pfad]] = []
+        self.herkunft: List[Optional[Tuple[int, List[Tuple[int, int]]]]] = []
+
         # fuer Statistik spaeter zum Vergleich
         self.beste_fitness_generation: List[float] = []
         self.durchschnitt_fitness_generation: List[float] = []
         self.best_level: Optional[np.ndarray] = None
         self.beste_fitness: float = float('-inf')
 
-    def initialisiere_population(self):
-        self.population = []
-
-        for i in range(self.population_size):
-            # zufallslevel wird zu matrix
-            grid = LevelBuilder.zufalls_level(self.breite, self.hoehe, PLATTFORM_WAHRSCHEINLICHKEIT)
-
-            matrix = grid.grid_matrix()
-            self.population.append(matrix)
+    def initialisiere_population(self, fitness_evaluator: Optional[SimpleFitness] = None):
+        # alle Level auf einmal als Tensor, jede Matrix ist eine Zeile davon
+        if self.konstruktiv:
+            konfig = fitness_evaluator.konfig if fitness_evaluator is not None else STANDARD_PHYSIK
+            konstrukteur = LevelKonstrukteur(self.breite, self.hoehe, konfig, PLATTFORM_WAHRSCHEINLICHKEIT)
+            level = konstrukteur.erzeuge_batch(self.population_size, self.rng)
+        else:
+            level = LevelBuilder.zufalls_level_batch(self.population_size, self.breite, self.hoehe,
+                                                     PLATTFORM_WAHRSCHEINLICHKEIT, rng=self.rng)
+        self.population = level
         print(f"Population initialisiert: {len(self.population)} Level")
 
     def evaluiere_population(self, fitness_evaluator: SimpleFitness):
-        self.fitnesses = []
-
-        for i, matrix in enumerate(self.population):
-            # matrix wird wieder zu grid
-            grid = LevelBuilder.matrix_grid(matrix)
-
-            fitness = fitness_evaluator.berechne_fitness(grid)
-            print(fitness)
-            self.fitnesses.append(fitness)
-
-            if (i + 1) % 10 == 0:
-                print(f"  Evaluiert: {i + 1}/{len(self.population)}")
-
+        # ganze Population als Tensor bewerten, unloesbare Level werden dabei gemeinsam aussortiert
+        eltern_pfade, geaenderte_zellen = None, None
+        if self.inkrementell and len(self.herkunft) == len(self.population):
+            eltern_pfade = [self.pfade[h[0]] if h is not None else None for h in self.herkunft]
+            geaenderte_zellen = [h[1] if h is not None else None for h in self.herkunft]
+
+        self.ergebnisse, self.pfade = fitness_evaluator.bewerte_population(self.population, eltern_pfade,
+                                                                          geaenderte_zellen)
+        self.fitnesses = self.ergebnisse["fitness"]
         self.update_statistiken()
 
     def update_statistiken(self):
-        beste = max(self.fitnesses)
-        durchschnitt = sum(self.fitnesses) / len(self.fitnesses)
+        beste_index = int(np.argmax(self.fitnesses))
+        beste = float(self.fitnesses[beste_index])
+        durchschnitt = float(np.mean(self.fitnesses))
 
         self.beste_fitness_generation.append(beste)
         self.durchschnitt_fitness_generation.append(durchschnitt)
 
         if beste > self.beste_fitness:
             self.beste_fitness = beste
-            beste_index = self.fitnesses.index(beste)
             self.best_level = self.population[beste_index].copy()
 
-    def selektiere(self) -> Tuple[np.ndarray, np.ndarray]:
-        # https://www.baeldung.com/cs/ga-tournament-selection#bd-the-algorithm
-        def tournament() -> np.ndarray:
-            individuen = np.random.choice(len(self.population), size=TOURNAMENT, replace=False)
-
-            tournament_fitnesses = [self.fitnesses[i] for i in individuen]
-            best = np.argmax(tournament_fitnesses)
-            best_index = individuen[best]
+    def selektiere_index(self) -> Tuple[int, int]:
+        index1, index2 = self.selektiere_index_batch(2).tolist()
+        return index1, index2
+
+    def selektiere_index_batch(self, anzahl: int) -> np.ndarray:
+        # Indizes von anzahl Eltern fuer die ganze Generation auf einmal
+        fitnesses = np.asarray(self.fitnesses, dtype=float)
+        groesse = len(fitnesses)
+
+        if self.selektion == "tournament":
+            # https://www.baeldung.com/cs/ga-tournament-selection#bd-the-algorithm
+            # jede Zeile ist ein Turnier aus TOURNAMENT verschiedenen Individuen
+            teilnehmer = min(TOURNAMENT, groesse)
+            individuen = self.rng.integers(0, groesse, size=(anzahl, teilnehmer))
+            # Zeilen mit doppelten Teilnehmern werden neu gezogen, wie np.random.choice(..., replace=False)
+            while True:
+                sortiert = np.sort(individuen, axis=1)
+                doppelt = np.flatnonzero((sortiert[:, 1:] == sortiert[:, :-1]).any(axis=1))
+                if len(doppelt) == 0:
+                    break
+                individuen[doppelt] = self.rng.integers(0, groesse, size=(len(doppelt), teilnehmer))
+            gewinner = np.argmax(fitnesses[individuen], axis=1)
+            return individuen[np.arange(anzahl), gewinner]
+
+        if self.selektion == "rang":
+            # lineares Ranking: das schlechteste Individuum hat Gewicht 1, das beste Gewicht groesse
+            raenge = np.empty(groesse)
+            raenge[np.argsort(fitnesses, kind="stable")] = np.arange(1, groesse + 1)
+            return self.rng.choice(groesse, size=anzahl, p=raenge / raenge.sum())
+
+        # stochastic universal sampling: anzahl gleich weit entfernte Zeiger ueber die kumulierte Fitness
+        gewichte = fitnesses - fitnesses.min()
+        if gewichte.sum() <= 0:
+            gewichte = np.ones(groesse)
+        kumuliert = np.cumsum(gewichte)
+        abstand = kumuliert[-1] / anzahl
+        zeiger = self.rng.uniform(0, abstand) + abstand * np.arange(anzahl)
+        index = np.minimum(np.searchsorted(kumuliert, zeiger, side="right"), groesse - 1)
+        # SUS liefert die Eltern sortiert, gemischt werden die Paare zufaellig
+        return self.rng.permutation(index)
 
-            return self.population[best_index].copy()
-
-        return tournament(), tournament()
+    def selektiere(self) -> Tuple[np.ndarray, np.ndarray]:
+        index1, index2 = self.selektiere_index()
+        return self.population[index1].copy(), self.population[index2].copy()
 
     def crossover(self, eltern: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
-        kind1 = eltern[0].copy()
-        kind2 = eltern[1].copy()
-
-        split_y = np.random.randint(2, self.hoehe - 1)
+        kinder = np.stack(eltern)[None]
+        self.crossover_batch(kinder, np.ones(1, dtype=bool))
 
-        kind1[:split_y, :] = eltern[1][:split_y, :]
-        kind2[:split_y, :] = eltern[0][:split_y, :]
+        return self.repariere_level(kinder[0, 0]), self.repariere_level(kinder[0, 1])
 
-        kind1 = self.repariere_level(kind1)
-        kind2 = self.repariere_level(kind2)
+    def crossover_batch(self, paare: np.ndarray, gekreuzt: np.ndarray) -> None:
+        # paare (anzahl, 2, hoehe, breite) wird in place gekreuzt: bei den gekreuzten Paaren werden alle Reihen
+        # oberhalb eines zufaelligen split_y pro Paar zwischen den beiden Kindern getauscht
+        split_y = self.rng.integers(2, self.hoehe - 1, size=len(paare))
+        tausch = gekreuzt[:, None] & (np.arange(self.hoehe)[None, :] < split_y[:, None])
 
-        return kind1, kind2
+        kind1, kind2 = paare[:, 0], paare[:, 1]
+        oben1 = kind1[tausch]
+        kind1[tausch] = kind2[tausch]
+        kind2[tausch] = oben1
 
     def mutiere(self, individuum: np.ndarray) -> np.ndarray:
         # Mutiere ein Individuum (Nicht Boden oder Start/Ziel)
         # Level soll nicht dadurch instantly failen (Start/Ziel) oder Boden weg
-        mutiert = individuum.copy()
-
-        for y in range(self.hoehe - 1):
-            for x in range(self.breite):
-                if np.random.random() < self.mutation_wahrscheinlichkeit:
-                    if mutiert[y, x] not in [START, ZIEL]:
-                        if np.random.random() < LUFT_MUTATION:
-                            mutiert[y, x] = LUFT
-                        else:
-                            mutiert[y, x] = PLATTFORM
-        mutiert = self.repariere_level(mutiert)
-        return mutiert
+        mutiert = individuum[None].copy()
+        self.mutiere_batch(mutiert)
+        return self.repariere_level(mutiert[0])
+
+    def mutiere_batch(self, kinder: np.ndarray) -> List[List[Tuple[int, int]]]:
+        # alle Kinder (anzahl, hoehe, breite) in place, unterste Reihe und Start/Ziel bleiben
+        # bei kleiner Rate wird statt einer Zufallszahl pro Zelle nur die Anzahl der Mutationen pro Kind binomial gezogen
+        # und dann genau so viele verschiedene Zellen, der Aufwand haengt also nur von der Anzahl der Mutationen ab
+        # Rueckgabe: pro Kind die Zellen (x, y), die sich wirklich geaendert haben
+        zellen = (self.hoehe - 1) * self.breite
+        if self.mutation_wahrscheinlichkeit > DUENNE_MUTATION:
+            kind, zelle = np.nonzero(self.rng.random((len(kinder), zellen)) < self.mutation_wahrscheinlichkeit)
+        else:
+            anzahl = self.rng.binomial(zellen, self.mutation_wahrscheinlichkeit, size=len(kinder))
+            kind = np.repeat(np.arange(len(kinder)), anzahl)
+            zelle = self.rng.integers(0, zellen, size=len(kind))
+
+            # doppelte Zellen innerhalb eines Kindes neu ziehen, wie bei der Maske wird jede Zelle hoechstens einmal mutiert
+            while True:
+                _, erste = np.unique(kind * zellen + zelle, return_index=True)
+                doppelt = np.ones(len(kind), dtype=bool)
+                doppelt[erste] = False
+                if not doppelt.any():
+                    break
+                zelle[doppelt] = self.rng.integers(0, zellen, size=np.count_nonzero(doppelt))
+
+        y, x = np.divmod(zelle, self.breite)
+        alt = kinder[kind, y, x]
+        erlaubt = (alt != START) & (alt != ZIEL)
+        kind, y, x, alt = kind[erlaubt], y[erlaubt], x[erlaubt], alt[erlaubt]
+
+        neu = np.where(self.rng.random(len(kind)) < LUFT_MUTATION, LUFT, PLATTFORM).astype(kinder.dtype)
+        kinder[kind, y, x] = neu
+
+        geaendert = neu != alt
+        kind, y, x = kind[geaendert], y[geaendert], x[geaendert]
+        grenzen = np.searchsorted(kind, np.arange(len(kinder) + 1))
+        xs, ys = x.tolist(), y.tolist()
+        return [list(zip(xs[von:bis], ys[von:bis])) for von, bis in zip(grenzen[:-1].tolist(), grenzen[1:].tolist())]
 
     def repariere_level(self, individuum: np.ndarray) -> np.ndarray:
         # Soll das komplette Zerstören beim Crossover und Mutation verhindern
         # Wenn Ziel/Start fehlt/zu viel gibt wird eins erstellt/ausgesucht
-        repariert = individuum.copy()
-        start_pos = np.argwhere(repariert == START)
-        ziel_pos = np.argwhere(repariert == ZIEL)
-
-        if len(start_pos) == 0:
-            repariert[self.hoehe - 2, 1] = START
-            start_pos = [(self.hoehe - 2, 1)]
-        elif len(start_pos) > 1:
-            for i in range(1, len(start_pos)):
-                y, x = start_pos[i]
-                repariert[y, x] = LUFT
-            start_pos = [start_pos[0]]
-
-        if len(ziel_pos) == 0:
-            ziel_y = np.random.randint(2, self.hoehe - 2)
-            repariert[ziel_y, self.breite - 2] = ZIEL
-            ziel_pos = [(ziel_y, self.breite - 2)]
-        elif len(ziel_pos) > 1:
-            for i in range(1, len(ziel_pos)):
-                y, x = ziel_pos[i]
-                repariert[y, x] = LUFT
-            ziel_pos = [ziel_pos[0]]
-
-        ziel_y, ziel_x = ziel_pos[0]
-        if ziel_y + 1 < self.hoehe:
-            repariert[ziel_y + 1, ziel_x] = PLATTFORM
-
-        return repariert
+        repariert = individuum[None].copy()
+        self.repariere_batch(repariert)
+        return repariert[0]
+
+    def repariere_batch(self, level: np.ndarray) -> None:
+        # repariere_level fuer alle Level (anzahl, hoehe, breite) auf einmal, in place
+        # pro Level bleibt nur der erste Start/das erste Ziel (Zeile fuer Zeile), fehlende werden gesetzt,
+        # danach kommt unter jedes Ziel eine Plattform
+        anzahl = len(level)
+        # flach muss eine Sicht auf dieselben Daten sein, nicht zusammenhaengende Level werden am Ende zurueckgeschrieben
+        arbeit = np.ascontiguousarray(level)
+        flach = arbeit.reshape(anzahl, -1)
+
+        for tile in (START, ZIEL):
+            vorhanden = flach == tile
+            # cumsum zaehlt pro Level mit, alles nach dem ersten Vorkommen wird zu Luft
+            flach[vorhanden & (np.cumsum(vorhanden, axis=1) > 1)] = LUFT
+
+            fehlt = np.flatnonzero(~vorhanden.any(axis=1))
+            if tile == START:
+                arbeit[fehlt, self.hoehe - 2, 1] = START
+            else:
+                arbeit[fehlt, self.rng.integers(2, self.hoehe - 2, size=len(fehlt)), self.breite - 2] = ZIEL
+
+        ziel_y, ziel_x = np.divmod(np.argmax(flach == ZIEL, axis=1), self.breite)
+        darunter = ziel_y + 1 < self.hoehe
+        arbeit[np.flatnonzero(darunter), ziel_y[darunter] + 1, ziel_x[darunter]] = PLATTFORM
+
+        if arbeit is not level:
+            level[...] = arbeit
 
     def next_generation(self):
         # naechte Generation mit Elite (Top2) und der Rest mit Crossover/Mutation
-        population = []
+        # alle Kinder werden direkt in einen neuen Tensor geschrieben: erst die Eltern, dann Crossover und Mutation in place
         index = np.argsort(self.fitnesses)[::-1]
+        anzahl_paare = (self.population_size - self.elite + 1) // 2
 
-        for i in range(self.elite):
-            elite_index = index[i]
-            population.append(self.population[elite_index].copy())
+        neu = np.empty((self.elite + 2 * anzahl_paare, self.hoehe, self.breite), dtype=TILE_DTYPE)
+        neu[:self.elite] = self.population[index[:self.elite]]
+        herkunft = [(int(i), []) for i in index[:self.elite]]
 
-        while len(population) < self.population_size:
-            eltern = self.selektiere()
+        eltern_index = self.selektiere_index_batch(2 * anzahl_paare).reshape(anzahl_paare, 2)
+        paare = neu[self.elite:].reshape(anzahl_paare, 2, self.hoehe, self.breite)
+        np.take(self.population, eltern_index, axis=0, out=paare)
 
-            if np.random.random() < self.crossover_wahrscheinlichkeit:
-                kind1, kind2 = self.crossover(eltern)
-            else:
-                kind1, kind2 = eltern[0].copy(), eltern[1].copy()
+        gekreuzt = self.rng.random(anzahl_paare) < self.crossover_wahrscheinlichkeit
+        self.crossover_batch(paare, gekreuzt)
 
-            kind1 = self.mutiere(kind1)
-            kind2 = self.mutiere(kind2)
+        kinder = neu[self.elite:]
+        mutiert = self.mutiere_batch(kinder)
+        self.repariere_batch(kinder)
 
-            population.append(kind1)
-            if len(population) < self.population_size:
-                population.append(kind2)
+        # ohne Crossover unterscheidet sich ein Kind vom Elternteil hoechstens in den mutierten Zellen
+        # (die Reparatur setzt dort nur z.B. die Plattform unter dem Ziel zurueck), kein Vergleich ganzer Level noetig
+        population = neu[:self.population_size]
+        for i, elternteil in enumerate(eltern_index.ravel()[:self.population_size - self.elite].tolist()):
+            if gekreuzt[i // 2]:
+                herkunft.append(None)
+            else:
+                kind, eltern = kinder[i], self.population[elternteil]
+                herkunft.append((elternteil, [(x, y) for x, y in mutiert[i] if kind[y, x] != eltern[y, x]]))
 
         self.population = population
+        self.herkunft = herkunft
         self.generation += 1
 
-    def evolution(self, generationen: int, fitness_evaluator: SimpleFitness, verbose: bool = True):
+    def evolution(self, generationen: int, fitness_evaluator: SimpleFitness, verbose: bool = True,
+                  archiv: Optional[LevelArchiv] = None):
         # print methode wurde generiert mit Copilot
         print(f"\n{'='*60}")
         print(f"STARTE EVOLUTION")
@@ -192,6 +287,10 @@ class GeneticAlgorithm:
             # Evaluiere
             self.evaluiere_population(fitness_evaluator)
 
+            # jede bewertete Generation wird ans Archiv angehaengt
+            if archiv is not None:
+                archiv.anhaengen(self.population, self.fitnesses, self.generation)
+
             # Statistiken
             if verbose:
                 stats = fitness_evaluator.get_statistiken()
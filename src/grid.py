@@ -1,3 +1,5 @@
+import os
+import glob
 import numpy as np
 from typing import Tuple, List, Optional
 
@@ -9,17 +11,160 @@ START = 3
 ZIEL = 4
 
 
+# 5 Tile Typen passen in ein Byte, spart gegenueber int64 8x Speicher bei grossen Populationen
+TILE_DTYPE = np.uint8
+
+# Textformat der Level Dateien, Index = Tile
+TILE_ZEICHEN = b".#=SZ"
+
+
+class LevelCodec:
+    # uebersetzt das .#=SZ Textformat mit Lookup Tabellen statt Zeichen fuer Zeichen
+    # unbekannte Zeichen werden wie bisher zu LUFT
+    ZU_TEXT = np.frombuffer(TILE_ZEICHEN, dtype=np.uint8)
+    ZU_TILE = np.full(256, LUFT, dtype=TILE_DTYPE)
+    ZU_TILE[ZU_TEXT] = np.arange(len(TILE_ZEICHEN), dtype=TILE_DTYPE)
+
+    @staticmethod
+    def kodiere(tiles: np.ndarray) -> str:
+        # (hoehe, breite) -> eine Zeile Text pro Reihe, jede mit \n abgeschlossen
+        zeichen = LevelCodec.ZU_TEXT[tiles]
+        zeilen = np.full((tiles.shape[0], tiles.shape[1] + 1), ord("\n"), dtype=np.uint8)
+        zeilen[:, :-1] = zeichen
+        return zeilen.tobytes().decode("ascii")
+
+    @staticmethod
+    def dekodiere(text: str) -> np.ndarray:
+        # Kopfzeile "Beste Fitness" und Leerzeilen werden uebersprungen, breite/hoehe kommen aus dem Text
+        # kuerzere Zeilen werden mit LUFT aufgefuellt
+        # nur ASCII: ein Zeichen aus mehreren Bytes wuerde alle folgenden Spalten verschieben
+        try:
+            roh = text.encode("ascii", errors="strict")
+        except UnicodeEncodeError as fehler:
+            zeile = text.count("\n", 0, fehler.start) + 1
+            raise ValueError(f"Level Text enthaelt {text[fehler.start]!r} in Zeile {zeile}, erlaubt ist nur ASCII") from fehler
+        zeilen = [z for z in roh.splitlines()
+                  if z.strip() and not z.startswith(b"Beste Fitness")]
+        if not zeilen:
+            return np.zeros((0, 0), dtype=TILE_DTYPE)
+
+        breite = max(len(z) for z in zeilen)
+        roh = b"".join(z.ljust(breite, b".") for z in zeilen)
+        zeichen = np.frombuffer(roh, dtype=np.uint8).reshape(len(zeilen), breite)
+        return LevelCodec.ZU_TILE[zeichen]
+
+    @staticmethod
+    def lade(dateipfad: str) -> np.ndarray:
+        # utf-8 lesen, damit dekodiere falsche Zeichen mit Zeilennummer melden kann
+        with open(dateipfad, "r", encoding="utf-8", errors="strict") as f:
+            tiles = LevelCodec.dekodiere(f.read())
+        # leere Datei oder nur Kopfzeile, sonst scheitert erst ein spaeterer Zugriff mit IndexError
+        if tiles.size == 0:
+            raise ValueError(f"{dateipfad} enthaelt kein Level")
+        return tiles
+
+    @staticmethod
+    def speichere(dateipfad: str, tiles: np.ndarray, kopfzeile: Optional[str] = None) -> None:
+        with open(dateipfad, "w", encoding="ascii") as f:
+            if kopfzeile is not None:
+                f.write(f"{kopfzeile}\n\n")
+            f.write(LevelCodec.kodiere(tiles))
+
+    @staticmethod
+    def lade_verzeichnis(verzeichnis: str, muster: str = "*.txt") -> Tuple[np.ndarray, List[str]]:
+        # alle Level Dateien eines Ordners (nach Namen sortiert) als ein (N, hoehe, breite) Stapel
+        dateien = sorted(glob.glob(os.path.join(verzeichnis, muster)))
+        if not dateien:
+            return np.zeros((0, 0, 0), dtype=TILE_DTYPE), []
+
+        level = [LevelCodec.lade(datei) for datei in dateien]
+        formen = {l.shape for l in level}
+        if len(formen) > 1:
+            raise ValueError(f"Level in {verzeichnis} haben unterschiedliche Groessen: {sorted(formen)}")
+        return np.stack(level), dateien
+
+
 class Grid:
+    __slots__ = ("breite", "hoehe", "_daten", "_tiles", "version", "_solid", "_stehbar", "_kopffrei", "_start", "_ziel")
 
     def __init__(self, breite: int = 20, hoehe: int = 10):
         self.breite = breite
         self.hoehe = hoehe
 
         # Kiene Liste von einer Liste, da später mit EA gearbeitet werden und da numpy gut ist
-        self.tiles = np.zeros((hoehe, breite), dtype=int)
+        tiles = np.zeros((hoehe, breite), dtype=TILE_DTYPE)
 
         # Jedes level sollte erstmal ein Boden haben, diese können bei der Generation von Leveln eventuell mit Lücken gefuellt werden
-        self.tiles[hoehe - 1, :] = BODEN
+        tiles[hoehe - 1, :] = BODEN
+        self.tiles = tiles
+
+    @classmethod
+    def view(cls, matrix: np.ndarray) -> 'Grid':
+        # Grid ohne Kopie um eine vorhandene Matrix (z.B. ein Level aus dem Populations-Tensor), nur lesbar
+        # Nur wenn die Matrix nicht schon uint8 ist, wird einmal konvertiert
+        # die Matrix darf sich waehrend das Grid benutzt wird nicht aendern
+        g = cls.__new__(cls)
+        g.hoehe, g.breite = matrix.shape
+        g.uebernehme(np.asarray(matrix, dtype=TILE_DTYPE), beschreibbar=False)
+        return g
+
+    @property
+    def tiles(self) -> np.ndarray:
+        # immer nur lesbar, geschrieben wird ueber set_tile/setze, damit die Caches nicht veralten
+        return self._tiles
+
+    @tiles.setter
+    def tiles(self, tiles: np.ndarray) -> None:
+        # das Grid bekommt eine eigene Kopie, so kann niemand sie an den Caches vorbei aendern
+        self.uebernehme(np.array(tiles, dtype=TILE_DTYPE), beschreibbar=True)
+
+    def uebernehme(self, daten: np.ndarray, beschreibbar: bool) -> None:
+        # _daten ist der beschreibbare Speicher (None bei Grid.view), nach aussen gibt es nur eine lesbare Sicht
+        self._daten = daten if beschreibbar else None
+        self._tiles = daten.view()
+        self._tiles.flags.writeable = False
+        # version zaehlt Aenderungen, damit abgeleitete Caches (z.B. in PhysikEngine) veraltete Daten erkennen
+        self.version = getattr(self, "version", 0)
+        self.invalidiere()
+
+    def __getstate__(self) -> Tuple:
+        # copy/deepcopy/pickle duerfen _daten und _tiles nicht getrennt kopieren, sonst schreibt setze am Cache vorbei
+        return self.breite, self.hoehe, np.array(self._tiles), self._daten is not None, self.version
+
+    def __setstate__(self, zustand: Tuple) -> None:
+        self.breite, self.hoehe, daten, beschreibbar, self.version = zustand
+        self.uebernehme(daten, beschreibbar=beschreibbar)
+
+    def invalidiere(self) -> None:
+        # Masken und Start/Ziel werden erst bei Bedarf neu berechnet, wird bei jeder Aenderung aufgerufen
+        self.version += 1
+        self._solid = None
+        self._stehbar = None
+        self._kopffrei = None
+        self._start = ()
+        self._ziel = ()
+
+    def solid_maske(self) -> np.ndarray:
+        # Boden oder Plattform
+        if self._solid is None:
+            self._solid = (self._tiles == BODEN) | (self._tiles == PLATTFORM)
+        return self._solid
+
+    def stehbar_maske(self) -> np.ndarray:
+        # nicht solide und darunter solide, also die Zellen auf denen man stehen kann
+        if self._stehbar is None:
+            solid = self.solid_maske()
+            self._stehbar = ~solid
+            self._stehbar[:-1] &= solid[1:]
+            self._stehbar[-1] = False
+        return self._stehbar
+
+    def kopffrei_maske(self) -> np.ndarray:
+        # ueber der Zelle ist nichts solides (oberste Zeile hat immer Kopffreiheit)
+        if self._kopffrei is None:
+            self._kopffrei = np.ones_like(self.solid_maske())
+            self._kopffrei[1:] = ~self._solid[:-1]
+        return self._kopffrei
 
     def ist_im_grid(self, x: int, y: int) -> bool:
         # ist punkt im grid?
@@ -28,41 +173,52 @@ class Grid:
     def get_tile(self, x: int, y: int) -> int:
         if self.ist_im_grid(x, y):
             # numpy ist matrix daher (Reihe/Spalte), deswegen hier y,x anstelle x,y
-            return int(self.tiles[y, x])
+            return int(self._tiles[y, x])
         return LUFT
 
     def set_tile(self, x: int, y: int, tile_typ: int) -> None:
-        if self.ist_im_grid(x, y):
-            self.tiles[y, x] = tile_typ
+        if self.ist_im_grid(x, y) and self._tiles[y, x] != tile_typ:
+            self.setze(y, x, tile_typ)
+
+    def setze(self, y, x, tile_typ: int) -> None:
+        # schreibt in numpy Reihenfolge (y, x), auch Index Arrays oder Masken, und invalidiert die Caches
+        if self._daten is None:
+            raise ValueError("Grid.view ist nur lesbar")
+        self._daten[y, x] = tile_typ
+        self.invalidiere()
 
     def ist_solid(self, x: int, y: int) -> bool:
         # ist tile solide? also boden oder plattform
-        tile = self.get_tile(x, y)
-        return tile in (BODEN, PLATTFORM)
+        return self.ist_im_grid(x, y) and bool(self.solid_maske()[y, x])
 
     def ist_begehbar(self, x: int, y: int) -> bool:
         # Tile darf kein kein Boden/Plattform sein und darunter muss Boden oder PLattform sein
-        tile = self.get_tile(x, y)
-        return (tile not in (BODEN, PLATTFORM)) and self.hat_boden_darunter(x, y)
+        if self.ist_im_grid(x, y):
+            return bool(self.stehbar_maske()[y, x])
+        # ausserhalb ist Luft, nur der Boden darunter zaehlt
+        return self.hat_boden_darunter(x, y)
 
     def hat_boden_darunter(self, x: int, y: int) -> bool:
         return self.ist_solid(x, y + 1)
 
-    def get_start(self) -> Optional[Tuple[int, int]]:
-        # Hole Start position wenne existiert
-        positionen = np.argwhere(self.tiles == START)
-        if len(positionen == 1):
+    def finde_erstes(self, tile_typ: int) -> Optional[Tuple[int, int]]:
+        positionen = np.argwhere(self._tiles == tile_typ)
+        if len(positionen) > 0:
             y, x = positionen[0]
-            return x, y
+            return int(x), int(y)
         return None
 
+    def get_start(self) -> Optional[Tuple[int, int]]:
+        # Hole Start position wenne existiert, wird bis zur naechsten Aenderung gecacht
+        if self._start == ():
+            self._start = self.finde_erstes(START)
+        return self._start
+
     def get_ziel(self) -> Optional[Tuple[int, int]]:
-        # Hole Ziel position wenne existiert
-        positionen = np.argwhere(self.tiles == ZIEL)
-        if len(positionen == 1):
-            y, x = positionen[0]
-            return x, y
-        return None
+        # Hole Ziel position wenne existiert, wird bis zur naechsten Aenderung gecacht
+        if self._ziel == ():
+            self._ziel = self.finde_erstes(ZIEL)
+        return self._ziel
 
     def hat_start_ziel(self) -> bool:
         # muss haben damit level valide ist
@@ -218,45 +374,46 @@ class LevelBuilder:
 
         return g
 
+    @staticmethod
+    def zufalls_level_batch(anzahl: int, breite: int = 20, hoehe: int = 10, plattform_wahrscheinlichkeit: float = 0.15,
+                            luecken_wahrscheinlichkeit: float = 0.15,
+                            rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        # wie zufalls_level, aber (anzahl, hoehe, breite) Level auf einmal als uint8 Tensor ohne Python Schleifen
+        if rng is None:
+            rng = np.random.default_rng()
+
+        level = np.zeros((anzahl, hoehe, breite), dtype=TILE_DTYPE)
+
+        innen = level[:, 1:hoehe - 2, 1:breite - 1]
+        innen[rng.random(innen.shape) < plattform_wahrscheinlichkeit] = PLATTFORM
+
+        # Luft im Boden aber nicht bei Start und Ziel
+        level[:, hoehe - 1, :] = BODEN
+        boden = level[:, hoehe - 1, 2:breite - 2]
+        boden[rng.random(boden.shape) < luecken_wahrscheinlichkeit] = LUFT
+
+        level[:, hoehe - 2, 1] = START
+
+        index = np.arange(anzahl)
+        ziel_y = rng.integers(1, hoehe - 2, size=anzahl)
+        level[index, ziel_y, breite - 2] = ZIEL
+        level[index, ziel_y + 1, breite - 2] = PLATTFORM
+
+        return level
+
     @staticmethod
     def matrix_grid(matrix: np.ndarray) -> Grid:
         hoehe, breite = matrix.shape
         g = Grid(breite, hoehe)
-        g.tiles = matrix.copy().astype(int)
+        # der tiles Setter kopiert und konvertiert
+        g.tiles = matrix
 
         return g
 
     @staticmethod
     def level_aus_screenshot(dateipfad: str) -> Grid:
-        g = Grid()
-        with open(dateipfad, "r", encoding="utf-8") as f:
-            zeilen = f.readlines()
-
-        layout = []
-        for z in zeilen:
-            z = z.rstrip("\n")
-            if z.startswith("Beste Fitness"):
-                continue
-            if not z.strip():
-                continue
-            layout.append(z)
-
-        for y, row in enumerate(layout):
-            for x, char in enumerate(row):
-                if char == '#':
-                    g.set_tile(x, y, BODEN)
-                elif char == '=':
-                    g.set_tile(x, y, PLATTFORM)
-                elif char == 'S':
-                    g.set_tile(x, y, START)
-                elif char == 'Z':
-                    g.set_tile(x, y, ZIEL)
-                elif char == '.':
-                    g.set_tile(x, y, LUFT)
-                else:
-                    g.set_tile(x, y, LUFT)
-
-        return g
+        # Groesse kommt aus der Datei, nicht mehr fest 20x10
+        return LevelBuilder.matrix_grid(LevelCodec.lade(dateipfad))
 
 class LevelValidator:
 
@@ -0,0 +1,174 @@
+import queue
+import multiprocessing as mp
+from typing import Dict, List, Optional
+from grid import Grid, LevelBuilder
+from fitness import SimpleFitness
+from genetics import GeneticAlgorithm
+
+import numpy as np
+
+
+def insel(nummer: int, ga_config: Dict, evaluator: SimpleFitness, rng: np.random.Generator, generationen: int,
+          intervall: int, migranten: int, einwanderer: mp.Queue, berichte: mp.Queue) -> None:
+    # eine Insel ist ein normaler GeneticAlgorithm mit eigenem Zufallsgenerator und eigenem Evaluator
+    # alle intervall Generationen werden die besten Level gemeldet und Einwanderer von der Nachbarinsel uebernommen
+    # Auswanderer reisen als (level, ergebnisse, pfade), damit sie nicht neu bewertet werden muessen
+    ga = GeneticAlgorithm(**ga_config, rng=rng)
+    ga.initialisiere_population(evaluator)
+    gemeldet = 0
+
+    for gen in range(generationen):
+        ga.evaluiere_population(evaluator)
+
+        letzte = gen == generationen - 1
+        migration = not letzte and (gen + 1) % intervall == 0
+        if migration or letzte:
+            besten = np.argsort(ga.fitnesses, kind="stable")[::-1][:migranten]
+            berichte.put({
+                'insel': nummer,
+                'beste_fitness_generation': ga.beste_fitness_generation[gemeldet:],
+                'durchschnitt_fitness_generation': ga.durchschnitt_fitness_generation[gemeldet:],
+                'beste_fitness': ga.beste_fitness,
+                'best_level': ga.best_level,
+                'auswanderer': (ga.population[besten].copy(), ga.ergebnisse[besten].copy(),
+                                [ga.pfade[i] for i in besten.tolist()]) if migration else None,
+                'evaluator_stats': evaluator.get_statistiken() if letzte else None
+            })
+            gemeldet = len(ga.beste_fitness_generation)
+
+        if letzte:
+            break
+
+        if migration:
+            # Einwanderer ersetzen die schlechtesten bewerteten Level, die Elite (die besten) bleibt also unberuehrt,
+            # und nehmen dann ganz normal an Selektion und Elite der naechsten Generation teil
+            neue, neue_ergebnisse, neue_pfade = einwanderer.get()
+            schlechteste = np.argsort(ga.fitnesses, kind="stable")[:len(neue)]
+            ga.population[schlechteste] = neue
+            # fitnesses ist eine Sicht auf ergebnisse["fitness"]
+            ga.ergebnisse[schlechteste] = neue_ergebnisse
+            for i, pfad in zip(schlechteste.tolist(), neue_pfade):
+                ga.pfade[i] = pfad
+
+        ga.next_generation()
+
+
+class InselModell:
+    # Insel Modell: anzahl_inseln Teilpopulationen entwickeln sich in eigenen Prozessen und tauschen alle
+    # migrations_intervall Generationen ihre besten migranten Level im Ring aus (Insel i -> Insel i + 1)
+    # Statistik und bestes Level werden hier zentral gesammelt, gleiche Attribute wie beim GeneticAlgorithm
+    # ga_config: Parameter fuer GeneticAlgorithm ohne rng, jede Insel bekommt ihren Generator aus seed
+    def __init__(self, ga_config: Optional[Dict] = None, fitness_evaluator: Optional[SimpleFitness] = None,
+                 anzahl_inseln: int = 4, migrations_intervall: int = 5, migranten: int = 2, seed: Optional[int] = None):
+        self.ga_config = dict(ga_config or {})
+        if 'rng' in self.ga_config:
+            raise ValueError("rng darf nicht in ga_config stehen, die Inseln werden ueber seed gesteuert")
+        if migrations_intervall <= 0:
+            raise ValueError("migrations_intervall muss groesser 0 sein")
+        # Konfiguration schon hier pruefen statt erst in den Inselprozessen
+        probe = GeneticAlgorithm(**self.ga_config, rng=np.random.default_rng(0))
+        if not 0 <= migranten <= probe.population_size - probe.elite:
+            raise ValueError(f"migranten muss zwischen 0 und {probe.population_size - probe.elite} liegen")
+        self.fitness_evaluator = fitness_evaluator if fitness_evaluator is not None else SimpleFitness()
+        self.anzahl_inseln = anzahl_inseln
+        self.migrations_intervall = migrations_intervall
+        self.migranten = migranten
+        self.seed = seed
+
+        self.generation = 0
+        self.beste_fitness_generation: List[float] = []
+        self.durchschnitt_fitness_generation: List[float] = []
+        # beste Fitness pro Generation fuer jede Insel einzeln, [insel][generation]
+        self.insel_beste_fitness: List[List[float]] = [[] for _ in range(anzahl_inseln)]
+        self.evaluator_statistiken: List[Optional[Dict]] = [None] * anzahl_inseln
+        self.best_level: Optional[np.ndarray] = None
+        self.beste_fitness: float = float('-inf')
+
+    def evolution(self, generationen: int, verbose: bool = True):
+        # jede Insel bekommt einen eigenen, unabhaengigen Zufallsstrom aus derselben SeedSequence
+        seeds = np.random.SeedSequence(self.seed).spawn(self.anzahl_inseln)
+
+        kontext = mp.get_context()
+        berichte = kontext.Queue()
+        einwanderer = [kontext.Queue() for _ in range(self.anzahl_inseln)]
+        prozesse = []
+        for nummer in range(self.anzahl_inseln):
+            # nicht daemonisch, damit eine Insel selbst Prozesse starten kann (z.B. ParallelEvaluator)
+            prozess = kontext.Process(target=insel, args=(
+                nummer, self.ga_config, self.fitness_evaluator, np.random.default_rng(seeds[nummer]), generationen,
+                self.migrations_intervall, self.migranten, einwanderer[nummer], berichte))
+            prozess.start()
+            prozesse.append(prozess)
+
+        migrationen = (generationen - 1) // self.migrations_intervall
+        try:
+            for runde in range(migrationen + 1):
+                runde_berichte = self.sammle_berichte(berichte, prozesse)
+                self.verarbeite_berichte(runde_berichte)
+
+                if verbose:
+                    print(f"Generation {self.generation}/{generationen}: Beste Fitness {self.beste_fitness:.2f}, "
+                          f"Durchschnitt {self.durchschnitt_fitness_generation[-1]:.2f}")
+
+                if runde < migrationen:
+                    for nummer, bericht in enumerate(runde_berichte):
+                        einwanderer[(nummer + 1) % self.anzahl_inseln].put(bericht['auswanderer'])
+        except BaseException:
+            for prozess in prozesse:
+                if prozess.is_alive():
+                    prozess.terminate()
+            raise
+        finally:
+            for prozess in prozesse:
+                prozess.join()
+
+        if verbose:
+            print(f"Beste Fitness: {self.beste_fitness:.2f}")
+
+    def sammle_berichte(self, berichte: mp.Queue, prozesse: List[mp.Process]) -> List[Dict]:
+        # ein Bericht pro Insel, nach Inselnummer sortiert; stirbt eine Insel wird nicht ewig gewartet
+        runde_berichte: List[Optional[Dict]] = [None] * self.anzahl_inseln
+        for _ in range(self.anzahl_inseln):
+            while True:
+                try:
+                    bericht = berichte.get(timeout=1)
+                    break
+                except queue.Empty:
+                    for nummer, prozess in enumerate(prozesse):
+                        if runde_berichte[nummer] is None and not prozess.is_alive():
+                            raise RuntimeError(f"Insel {nummer} wurde unerwartet beendet (exitcode {prozess.exitcode})")
+            runde_berichte[bericht['insel']] = bericht
+        return runde_berichte
+
+    def verarbeite_berichte(self, runde_berichte: List[Dict]) -> None:
+        # alle Inseln sind im Gleichschritt, jeder Bericht deckt dieselben Generationen ab
+        beste = np.array([b['beste_fitness_generation'] for b in runde_berichte])
+        durchschnitt = np.array([b['durchschnitt_fitness_generation'] for b in runde_berichte])
+
+        self.beste_fitness_generation.extend(beste.max(axis=0).tolist())
+        # gleich grosse Inseln, also ist der Mittelwert der Inseln der Mittelwert aller Individuen
+        self.durchschnitt_fitness_generation.extend(durchschnitt.mean(axis=0).tolist())
+        for nummer, bericht in enumerate(runde_berichte):
+            self.insel_beste_fitness[nummer].extend(bericht['beste_fitness_generation'])
+            if bericht['evaluator_stats'] is not None:
+                self.evaluator_statistiken[nummer] = bericht['evaluator_stats']
+            if bericht['beste_fitness'] > self.beste_fitness:
+                self.beste_fitness = bericht['beste_fitness']
+                self.best_level = bericht['best_level'].copy()
+        self.generation = len(self.beste_fitness_generation)
+
+    def get_best_level(self) -> Grid:
+        if self.best_level is None:
+            raise ValueError("Noch keine Evolution durchgeführt!")
+
+        return LevelBuilder.matrix_grid(self.best_level)
+
+    def get_statistiken(self) -> Dict:
+        return {
+            'generationen': self.generation,
+            'beste_fitness': self.beste_fitness,
+            'beste_fitness_pro_generation': self.beste_fitness_generation,
+            'durchschnitt_pro_generation': self.durchschnitt_fitness_generation,
+            'beste_fitness_pro_insel': self.insel_beste_fitness,
+            'evaluator_pro_insel': self.evaluator_statistiken
+        }
@@ -0,0 +1,152 @@
+from typing import List, Optional, Set, Tuple
+from grid import Grid, LUFT, BODEN, PLATTFORM, START, ZIEL
+from physics import PhysikEngine, Position, BewegungTyp, PhysikKonfig, STANDARD_PHYSIK
+from autoplayer import Autoplayer
+
+import numpy as np
+
+
+class LevelKonstrukteur:
+    # Erzeugt Level die schon beim Bau loesbar sind:
+    # 1. Zugfolge von Start nach rechts bis zur Zielspalte nach den Regeln der PhysikEngine ziehen
+    #    und nur die Plattformen setzen, die diese Zuege brauchen
+    # 2. zufaellige Deko (Plattformen, Luecken im Boden) nur ausserhalb der Zellen von denen die Zuege abhaengen
+    # 3. mit dem Autoplayer pruefen, wenn die Deko doch etwas kaputt macht wird das Level ohne Deko genommen
+
+    def __init__(self, breite: int = 20, hoehe: int = 10, konfig: PhysikKonfig = STANDARD_PHYSIK,
+                 plattform_wahrscheinlichkeit: float = 0.15, luecken_wahrscheinlichkeit: float = 0.15,
+                 lauf_wahrscheinlichkeit: float = 0.35, max_versuche: int = 20):
+        self.breite = breite
+        self.hoehe = hoehe
+        self.konfig = konfig
+        self.plattform_wahrscheinlichkeit = plattform_wahrscheinlichkeit
+        self.luecken_wahrscheinlichkeit = luecken_wahrscheinlichkeit
+        self.lauf_wahrscheinlichkeit = lauf_wahrscheinlichkeit
+        self.max_versuche = max_versuche
+
+        # Statistik wie oft auf den Notfall zurueckgegriffen werden musste
+        self.anzahl_level = 0
+        self.anzahl_ohne_deko = 0
+        self.anzahl_ohne_zugfolge = 0
+
+    def erzeuge(self, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        if rng is None:
+            rng = np.random.default_rng()
+        self.anzahl_level += 1
+
+        for _ in range(self.max_versuche):
+            gebaut = self.baue_zugfolge(rng)
+            if gebaut is not None:
+                break
+        else:
+            # sollte praktisch nie passieren: flacher Boden ist immer loesbar
+            self.anzahl_ohne_zugfolge += 1
+            gebaut = self.flaches_level()
+
+        grid, geschuetzt = gebaut
+        ohne_deko = grid.grid_matrix()
+
+        self.dekoriere(grid, geschuetzt, rng)
+        if Autoplayer(grid, konfig=self.konfig).ist_level_loesbar():
+            return grid.grid_matrix()
+
+        self.anzahl_ohne_deko += 1
+        return ohne_deko
+
+    def erzeuge_batch(self, anzahl: int, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        # gleiche Form wie LevelBuilder.zufalls_level_batch: (anzahl, hoehe, breite) uint8
+        if rng is None:
+            rng = np.random.default_rng()
+        return np.stack([self.erzeuge(rng) for _ in range(anzahl)])
+
+    def leeres_level(self) -> Grid:
+        grid = Grid(self.breite, self.hoehe)
+        for x in range(self.breite):
+            grid.set_tile(x, self.hoehe - 1, BODEN)
+        grid.set_tile(1, self.hoehe - 2, START)
+        return grid
+
+    def flaches_level(self) -> Tuple[Grid, Set[Tuple[int, int]]]:
+        grid = self.leeres_level()
+        grid.set_tile(self.breite - 2, self.hoehe - 2, ZIEL)
+        # Start bis Ziel und der Boden darunter bleiben frei von Deko
+        geschuetzt = {(x, y) for x in range(1, self.breite - 1) for y in (self.hoehe - 2, self.hoehe - 1)}
+        return grid, geschuetzt
+
+    def kandidaten(self, rng: np.random.Generator) -> List[Tuple[BewegungTyp, int, int]]:
+        # moegliche naechste Zuege nach rechts als (typ, hoehe, distanz), zufaellig sortiert
+        spruenge = [(BewegungTyp.SPRINGEN, hoehe, distanz)
+                    for hoehe in self.konfig.sprung_hoehen()
+                    for distanz in range(1, self.konfig.sprung_weite + 1)]
+        spruenge = [spruenge[i] for i in rng.permutation(len(spruenge))]
+
+        laufen = (BewegungTyp.LAUFEN, 0, 1)
+        if rng.random() < self.lauf_wahrscheinlichkeit:
+            return [laufen] + spruenge
+        return spruenge + [laufen]
+
+    def baue_zugfolge(self, rng: np.random.Generator) -> Optional[Tuple[Grid, Set[Tuple[int, int]]]]:
+        grid = self.leeres_level()
+        physik = PhysikEngine(grid, self.konfig)
+
+        position = Position(1, self.hoehe - 2)
+        # Zellen von denen die bisherigen Zuege abhaengen, die duerfen nicht mehr geaendert werden
+        geschuetzt: Set[Tuple[int, int]] = {(position.x, position.y), (position.x, position.y + 1)}
+
+        # jeder Zug geht mindestens ein Feld nach rechts, also endet die Schleife spaetestens in der Zielspalte
+        while position.x < self.breite - 2:
+            bewegung = None
+
+            for typ, hoehe, distanz in self.kandidaten(rng):
+                ziel = Position(position.x + distanz, position.y - hoehe)
+                stuetze = (ziel.x, ziel.y + 1)
+                if ziel.x > self.breite - 2 or not 1 <= ziel.y <= self.hoehe - 2:
+                    continue
+
+                # fehlende Stuetze unter dem Ziel setzen, aber nur wenn kein frueherer Zug davon abhaengt
+                gesetzt = False
+                if not grid.ist_solid(*stuetze):
+                    if stuetze in geschuetzt:
+                        continue
+                    grid.set_tile(stuetze[0], stuetze[1], PLATTFORM)
+                    gesetzt = True
+
+                # die PhysikEngine entscheidet ob der Zug so wirklich entsteht (z.B. weitester Sprung, Kopffreiheit)
+                bewegung = next((b for b in physik.finde_alle_nachbarn(position)
+                                 if b.typ == typ and b.ziel == ziel), None)
+                if bewegung is not None:
+                    break
+
+                if gesetzt:
+                    grid.set_tile(stuetze[0], stuetze[1], LUFT)
+
+            if bewegung is None:
+                return None
+
+            geschuetzt |= physik.abhaengige_zellen(bewegung)
+            position = bewegung.ziel
+
+        grid.set_tile(position.x, position.y, ZIEL)
+        return grid, geschuetzt
+
+    def dekoriere(self, grid: Grid, geschuetzt: Set[Tuple[int, int]], rng: np.random.Generator) -> None:
+        # gleiche Bereiche wie LevelBuilder.zufalls_level, aber ohne die geschuetzten Zellen
+        tiles = grid.grid_matrix()
+        frei = np.ones(tiles.shape, dtype=bool)
+        if geschuetzt:
+            xs, ys = zip(*geschuetzt)
+            xs, ys = np.array(xs), np.array(ys)
+            im_grid = (xs >= 0) & (xs < self.breite) & (ys >= 0) & (ys < self.hoehe)
+            frei[ys[im_grid], xs[im_grid]] = False
+
+        innen = np.zeros(tiles.shape, dtype=bool)
+        innen[1:self.hoehe - 2, 1:self.breite - 1] = True
+        plattformen = innen & frei & (tiles == LUFT) & (rng.random(tiles.shape) < self.plattform_wahrscheinlichkeit)
+        tiles[plattformen] = PLATTFORM
+
+        boden = np.zeros(tiles.shape, dtype=bool)
+        boden[self.hoehe - 1, 2:self.breite - 2] = True
+        luecken = boden & frei & (tiles == BODEN) & (rng.random(tiles.shape) < self.luecken_wahrscheinlichkeit)
+        tiles[luecken] = LUFT
+
+        grid.tiles = tiles
@@ -0,0 +1,210 @@
+import os
+import pickle
+import queue
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+from fitness import SimpleFitness, FITNESS_DTYPE
+from autoplayer import Pfad
+from grid import Grid
+
+import numpy as np
+
+# Teilstuecke pro Prozess, mehr als eins damit teure und billige Level sich besser verteilen
+STUECKE_PRO_PROZESS = 4
+
+
+def zaehler(evaluator: SimpleFitness) -> Dict:
+    # rohe Zaehler eines Evaluators, die Quoten werden erst nach dem Zusammenfuehren berechnet
+    return {'anzahl_level': evaluator.anzahl_level, 'anzahl_loesbare': evaluator.anzahl_loesbar,
+            'pfade_wiederverwendet': evaluator.anzahl_wiederverwendet,
+            'vorfilter_abgelehnt': dict(evaluator.vorfilter.abgelehnt),
+            'cache_treffer': evaluator.cache.treffer, 'cache_fehlschlaege': evaluator.cache.fehlschlaege}
+
+
+def arbeiter(evaluator: SimpleFitness, auftraege: mp.Queue, ergebnisse: mp.Queue) -> None:
+    # laeuft in jedem Prozess bis None kommt, der Evaluator (Cache, Autoplayer, Puffer) bleibt ueber alle Generationen
+    # ein Fehler bei einem Auftrag wird als (von, Exception, Traceback, None) zurueckgeschickt, der Prozess laeuft weiter
+    # die Kopie erbt die Zaehler des Hauptprozesses, die zaehlt get_statistiken dort schon einmal
+    evaluator.setze_zaehler_zurueck()
+    speicher: Optional[shared_memory.SharedMemory] = None
+    while True:
+        auftrag = auftraege.get()
+        if auftrag is None:
+            break
+        name, form, von, bis, eltern_pfade, geaenderte_zellen = auftrag
+
+        population = None
+        try:
+            if speicher is None or speicher.name != name:
+                if speicher is not None:
+                    speicher.close()
+                speicher = shared_memory.SharedMemory(name=name)
+            population = np.ndarray(form, dtype=np.uint8, buffer=speicher.buf)[von:bis]
+
+            ergebnis, pfade = evaluator.bewerte_population(population, eltern_pfade, geaenderte_zellen)
+            antwort = (von, ergebnis, pfade, zaehler(evaluator))
+        except Exception as fehler:
+            # ohne Traceback haelt die Exception keine Sichten auf den geteilten Speicher mehr fest
+            text = traceback.format_exc()
+            fehler = fehler.with_traceback(None)
+            try:
+                pickle.dumps(fehler)
+            except Exception:
+                fehler = RuntimeError(repr(fehler))
+            antwort = (von, fehler, text, None)
+        finally:
+            # population zeigt in den geteilten Speicher und darf nicht ueber den Auftrag hinaus leben
+            del population
+        ergebnisse.put(antwort)
+
+    if speicher is not None:
+        speicher.close()
+
+
+class ParallelEvaluator:
+    # Bewertet die Population auf mehreren Prozessen, gleiche Schnittstelle wie SimpleFitness/Fitness:
+    # die Population liegt einmal in shared_memory, jeder Prozess hat seinen eigenen Evaluator und bewertet feste
+    # Indexbereiche, die Ergebnisse werden nach Index zusammengesetzt und sind damit unabhaengig von der Laufzeit
+    def __init__(self, evaluator: SimpleFitness, prozesse: Optional[int] = None):
+        self.evaluator = evaluator
+        self.konfig = evaluator.konfig
+        self.prozesse = prozesse or os.cpu_count() or 1
+
+        self.speicher: Optional[shared_memory.SharedMemory] = None
+        # letzter Zaehlerstand jedes Prozesses
+        self.prozess_zaehler: List[Optional[Dict]] = [None] * self.prozesse
+        # der geteilte Speicher wird vor den Prozessen angelegt, damit sie die Verwaltung des Hauptprozesses erben,
+        # sonst meldet jeder Prozess den Speicher beim Beenden als Leck und entfernt ihn; wachsen kann er spaeter
+        self.teile_speicher(np.zeros(1, dtype=np.uint8))
+
+        # jeder Prozess bekommt eine Kopie des Evaluators (mit zurueckgesetzten Zaehlern) und eine eigene Auftragsschlange
+        kontext = mp.get_context()
+        self.ergebnisse = kontext.Queue()
+        self.auftraege = []
+        self.arbeiter = []
+        for _ in range(self.prozesse):
+            auftraege = kontext.Queue()
+            prozess = kontext.Process(target=arbeiter, args=(evaluator, auftraege, self.ergebnisse), daemon=True)
+            prozess.start()
+            self.auftraege.append(auftraege)
+            self.arbeiter.append(prozess)
+
+    def __enter__(self) -> 'ParallelEvaluator':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.schliesse()
+
+    def schliesse(self) -> None:
+        for auftraege in self.auftraege:
+            auftraege.put(None)
+        for prozess in self.arbeiter:
+            prozess.join(timeout=1)
+            if prozess.is_alive():
+                prozess.terminate()
+        self.auftraege = []
+        self.arbeiter = []
+
+        if self.speicher is not None:
+            self.speicher.close()
+            self.speicher.unlink()
+            self.speicher = None
+
+    def teile_speicher(self, population: np.ndarray) -> None:
+        # geteilter Speicher wird nur neu angelegt wenn die Population groesser wird
+        if self.speicher is None or self.speicher.size < population.size:
+            if self.speicher is not None:
+                self.speicher.close()
+                self.speicher.unlink()
+            self.speicher = shared_memory.SharedMemory(create=True, size=population.size)
+        geteilt = np.ndarray(population.shape, dtype=np.uint8, buffer=self.speicher.buf)
+        geteilt[...] = population
+
+    def berechne_fitness(self, grid: Grid, loesbar: Optional[bool] = None, eltern_pfad: Optional[Pfad] = None,
+                         geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> float:
+        # einzelne Level lohnen keinen Prozesswechsel
+        return self.evaluator.berechne_fitness(grid, loesbar, eltern_pfad, geaenderte_zellen)
+
+    def bewerte_level(self, grid: Grid, loesbar: Optional[bool] = None, eltern_pfad: Optional[Pfad] = None,
+                      geaenderte_zellen: Optional[List[Tuple[int, int]]] = None) -> Tuple[float, Optional[Pfad]]:
+        return self.evaluator.bewerte_level(grid, loesbar, eltern_pfad, geaenderte_zellen)
+
+    def berechne_fitness_batch(self, population: np.ndarray, eltern_pfade: Optional[List[Optional[Pfad]]] = None,
+                               geaenderte_zellen: Optional[List[Optional[List[Tuple[int, int]]]]] = None) -> np.ndarray:
+        ergebnis, _ = self.bewerte_population(population, eltern_pfade, geaenderte_zellen)
+        return ergebnis
+
+    def bewerte_population(self, population: np.ndarray, eltern_pfade: Optional[List[Optional[Pfad]]] = None,
+                           geaenderte_zellen: Optional[List[Optional[List[Tuple[int, int]]]]] = None
+                           ) -> Tuple[np.ndarray, List[Optional[Pfad]]]:
+        anzahl = len(population)
+        ergebnis = np.zeros(anzahl, dtype=FITNESS_DTYPE)
+        pfade: List[Optional[Pfad]] = [None] * anzahl
+        if anzahl == 0:
+            return ergebnis, pfade
+
+        self.teile_speicher(population)
+
+        # feste Zuordnung Stueck -> Prozess, damit auch Cache und Zaehler jedes Prozesses reproduzierbar sind
+        grenzen = np.linspace(0, anzahl, min(anzahl, self.prozesse * STUECKE_PRO_PROZESS) + 1).astype(int)
+        stuecke = list(zip(grenzen[:-1].tolist(), grenzen[1:].tolist()))
+        for nummer, (von, bis) in enumerate(stuecke):
+            self.auftraege[nummer % self.prozesse].put((
+                self.speicher.name, population.shape, von, bis,
+                eltern_pfade[von:bis] if eltern_pfade is not None else None,
+                geaenderte_zellen[von:bis] if geaenderte_zellen is not None else None))
+
+        # auch nach einem Fehler werden alle Stuecke abgeholt, damit keine alten Ergebnisse in der Schlange bleiben
+        zaehler_nach_stueck = {}
+        fehler = None
+        for _ in stuecke:
+            von, teil, teil_pfade, stand = self.hole_ergebnis()
+            if isinstance(teil, BaseException):
+                if fehler is None:
+                    fehler = (von, teil, teil_pfade)
+                continue
+            ergebnis[von:von + len(teil)] = teil
+            pfade[von:von + len(teil)] = teil_pfade
+            zaehler_nach_stueck[von] = stand
+
+        if fehler is not None:
+            von, exception, text = fehler
+            raise RuntimeError(f"Bewertung ab Level {von} fehlgeschlagen:\n{text}") from exception
+
+        # der Stand des letzten Stuecks eines Prozesses ist sein aktueller Zaehlerstand
+        for nummer, (von, _) in enumerate(stuecke):
+            self.prozess_zaehler[nummer % self.prozesse] = zaehler_nach_stueck[von]
+
+        return ergebnis, pfade
+
+    def hole_ergebnis(self) -> Tuple:
+        # wie InselModell.sammle_berichte: stirbt ein Prozess wird nicht ewig gewartet, sondern alles beendet
+        while True:
+            try:
+                return self.ergebnisse.get(timeout=1)
+            except queue.Empty:
+                for nummer, prozess in enumerate(self.arbeiter):
+                    if not prozess.is_alive():
+                        exitcode = prozess.exitcode
+                        self.schliesse()
+                        raise RuntimeError(f"Arbeiter {nummer} wurde unerwartet beendet (exitcode {exitcode})")
+
+    def get_statistiken(self) -> Dict:
+        # Zaehler aller Prozesse und des lokalen Evaluators aufsummiert
+        summe = zaehler(self.evaluator)
+        for stand in self.prozess_zaehler:
+            if stand is None:
+                continue
+            for schluessel, wert in stand.items():
+                if isinstance(wert, dict):
+                    for grund, anzahl in wert.items():
+                        summe[schluessel][grund] = summe[schluessel].get(grund, 0) + anzahl
+                else:
+                    summe[schluessel] += wert
+
+        anfragen = summe['cache_treffer'] + summe['cache_fehlschlaege']
+        summe['loesbarkeits_rate'] = summe['anzahl_loesbare'] / summe['anzahl_level'] if summe['anzahl_level'] else 0.0
+        summe['cache_trefferquote'] = summe['cache_treffer'] / anfragen if anfragen else 0.0
+        return summe
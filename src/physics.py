@@ -1,7 +1,13 @@
-from typing import Tuple, List, Optional
-from src.grid import Grid
+import heapq
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Tuple, List, Optional, Dict, Set
+from src.grid import Grid, LevelValidator, BODEN, PLATTFORM
 from enum import Enum
 
+import numpy as np
+
 # oben links ist (0,0) wegen numpy
 LINKS = -1
 RECHTS = +1
@@ -15,6 +21,37 @@ FALLKOSTEN = 1
 SPRUNG_HOEHE = 3
 SPRUNG_WEITE = 4
 FALL_DISTANZ_MAX = 10
+# Spruenge nach unten gehen bis zu SPRUNG_TIEFE Felder tief, darunter wird gefallen
+SPRUNG_TIEFE = 3
+
+
+@dataclass(frozen=True)
+class PhysikKonfig:
+    # unveraenderliche Bewegungsregeln, damit mehrere Physik Varianten in einem Prozess laufen koennen
+    # alles was daraus abgeleitet wird (Sprung-Templates, Heuristik Konstanten) wird pro Konfig nur einmal berechnet
+    laufkosten: int = LAUFKOSTEN
+    springkosten: int = SPRINGKOSTEN
+    fallkosten: int = FALLKOSTEN
+    sprung_hoehe: int = SPRUNG_HOEHE
+    sprung_weite: int = SPRUNG_WEITE
+    fall_distanz_max: int = FALL_DISTANZ_MAX
+    sprung_tiefe: int = SPRUNG_TIEFE
+
+    def sprung_hoehen(self) -> range:
+        # alle Hoehen die bei einem Sprung moeglich sind, negativ ist nach unten
+        return range(-self.sprung_tiefe, self.sprung_hoehe + 1)
+
+    def min_kosten_pro_feld(self) -> float:
+        # guenstigste Art ein Feld zur Seite zu kommen: laufen oder ein Teil eines weiten Sprungs
+        return min(self.laufkosten, self.springkosten / self.sprung_weite)
+
+    def rand(self) -> int:
+        # so weit kann eine Bewegung maximal aus einer Zelle herausfuehren
+        return max(self.sprung_weite, self.sprung_hoehe, self.sprung_tiefe, self.fall_distanz_max) + 2
+
+
+# Standard Konfig aus den Konstanten oben
+STANDARD_PHYSIK = PhysikKonfig()
 
 
 class BewegungTyp(Enum):
@@ -66,10 +103,238 @@ class Bewegung:
         return abs(self.ziel.y - self.start.y)
 
 
+# feste Reihenfolge der Bewegungstypen, im BewegungsGraph wird nur der Index gespeichert
+BEWEGUNGS_TYPEN = (BewegungTyp.LAUFEN, BewegungTyp.SPRINGEN, BewegungTyp.FALLEN)
+
+
+class BewegungsGraph:
+    # Kompilierte Physik eines Grids: alle Lauf-/Sprung-/Fallbewegungen als CSR Arrays
+    # Zelle i = y * breite + x, die Bewegungen von i liegen in ziele[offsets[i]:offsets[i + 1]]
+
+    def __init__(self, breite: int, hoehe: int, offsets: np.ndarray, ziele: np.ndarray, kosten: np.ndarray,
+                 typen: np.ndarray):
+        self.breite = breite
+        self.hoehe = hoehe
+        self.offsets = offsets
+        self.ziele = ziele
+        self.kosten = kosten
+        self.typen = typen
+        self._listen = None
+        self._rueckwaerts = None
+
+    def rueckwaerts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # umgedrehte Kanten als CSR: in quellen[offsets[j]:offsets[j + 1]] stehen alle Zellen, die nach j fuehren
+        if self._rueckwaerts is None:
+            anzahl = len(self.offsets) - 1
+            quellen = np.repeat(np.arange(anzahl), np.diff(self.offsets))
+            reihenfolge = np.argsort(self.ziele, kind='stable')
+            offsets = np.zeros(anzahl + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.ziele, minlength=anzahl), out=offsets[1:])
+            self._rueckwaerts = (offsets, quellen[reihenfolge], self.kosten[reihenfolge])
+        return self._rueckwaerts
+
+    def ziel_distanzen(self, ziel_index: int) -> np.ndarray:
+        # Dijkstra rueckwaerts vom Ziel: exakte Restkosten bis zum Ziel fuer jede Zelle, inf wenn das Ziel von dort
+        # nicht erreichbar ist. Ein Durchlauf pro Level beantwortet das fuer alle Zellen gleichzeitig
+        offsets, quellen, kosten = (a.tolist() for a in self.rueckwaerts())
+        distanzen = [float('inf')] * (len(offsets) - 1)
+        distanzen[ziel_index] = 0
+
+        open_list = [(0, ziel_index)]
+        while open_list:
+            distanz, current = heapq.heappop(open_list)
+            if distanz > distanzen[current]:
+                continue
+            for kante in range(offsets[current], offsets[current + 1]):
+                vorgaenger = quellen[kante]
+                neue_distanz = distanz + kosten[kante]
+                if neue_distanz < distanzen[vorgaenger]:
+                    distanzen[vorgaenger] = neue_distanz
+                    heapq.heappush(open_list, (neue_distanz, vorgaenger))
+
+        return np.array(distanzen).reshape(self.hoehe, self.breite)
+
+    def listen(self) -> Tuple[List[int], List[int], List[int], List[int]]:
+        # einzelne Zugriffe auf Python Listen sind schneller als auf numpy Arrays, daher fuer die A* Schleife
+        if self._listen is None:
+            self._listen = (self.offsets.tolist(), self.ziele.tolist(), self.kosten.tolist(), self.typen.tolist())
+        return self._listen
+
+    def index(self, x: int, y: int) -> int:
+        return y * self.breite + x
+
+    def koordinaten(self, index: int) -> Tuple[int, int]:
+        return index % self.breite, index // self.breite
+
+    def anzahl_kanten(self) -> int:
+        return len(self.ziele)
+
+    def bewegungen(self, von: Position) -> List[Bewegung]:
+        # erzeugt die gleichen Bewegungen wie PhysikEngine.finde_alle_nachbarn, aber nur noch als Array Zugriff
+        i = self.index(von.x, von.y)
+        bewegungen = []
+        for kante in range(self.offsets[i], self.offsets[i + 1]):
+            x, y = self.koordinaten(int(self.ziele[kante]))
+            bewegungen.append(Bewegung(start=von, ziel=Position(x, y), typ=BEWEGUNGS_TYPEN[self.typen[kante]],
+                                       kosten=int(self.kosten[kante])))
+        return bewegungen
+
+
+def sprung_zellen(richtung: int, hoehe: int, distanz: int) -> List[Tuple[int, int]]:
+    # relative Zellen die bei einem Sprung frei sein muessen, gleiche Interpolation wie in ist_sprung_frei
+    dx = richtung * distanz
+    dy = -hoehe
+    schritte = max(abs(dx), abs(dy))
+
+    zellen = []
+    for i in range(1, schritte + 1):
+        t = i / schritte
+        # floor statt int, da die absoluten Koordinaten im Grid nie negativ sind
+        zwischen_x = math.floor(dx * t)
+        zwischen_y = math.floor(dy * t)
+        # Flugbahn, Kopf beim Start und Kopf auf der Flugbahn
+        zellen.append((zwischen_x, zwischen_y))
+        zellen.append((zwischen_x, -1))
+        zellen.append((zwischen_x, zwischen_y - 1))
+    return zellen
+
+
+@lru_cache(maxsize=None)
+def sprung_templates(konfig: PhysikKonfig = STANDARD_PHYSIK) -> Dict[Tuple[int, int, int], Tuple[np.ndarray, np.ndarray]]:
+    # fuer jeden moeglichen Sprung (richtung, hoehe, distanz) die relativen Zellen einmal pro Konfig vorberechnen
+    templates = {}
+    for richtung in [LINKS, RECHTS]:
+        for hoehe in konfig.sprung_hoehen():
+            for distanz in range(1, konfig.sprung_weite + 1):
+                zellen = np.unique(np.array(sprung_zellen(richtung, hoehe, distanz)), axis=0)
+                templates[(richtung, hoehe, distanz)] = (zellen[:, 0], zellen[:, 1])
+    return templates
+
+
+# Die Zellen eines Sprungs haengen nur von (richtung, hoehe, distanz) und der Konfig ab
+SPRUNG_TEMPLATES = sprung_templates(STANDARD_PHYSIK)
+
+
+def berechne_bewegungen(tiles: np.ndarray, konfig: PhysikKonfig = STANDARD_PHYSIK) -> List[Tuple[int, int, List[Tuple[int, int, np.ndarray]]]]:
+    # alle Bewegungen eines Grids (H, W) oder eines ganzen Stapels (P, H, W) mit numpy Masken statt get_tile
+    # Rueckgabe pro Spalte (typ, kosten, [(dx, dy, maske)]): maske markiert die Zellen, deren Bewegung dieser
+    # Spalte um (dx, dy) fuehrt. Die Spalten haben die gleiche Reihenfolge wie finde_alle_nachbarn
+    hoehe, breite = tiles.shape[-2:]
+
+    # Rand aus Luft ausserhalb des Grids, damit Verschiebungen nicht aus dem Array laufen
+    rand = konfig.rand()
+    templates = sprung_templates(konfig)
+    polster = [(0, 0)] * (tiles.ndim - 2) + [(rand, rand), (rand, rand)]
+    solid = np.pad((tiles == BODEN) | (tiles == PLATTFORM), polster)
+    im_grid = np.pad(np.ones(tiles.shape, dtype=bool), polster)
+    boden = np.zeros_like(solid)
+    boden[..., :-1, :] = solid[..., 1:, :]
+    stehbar = im_grid & ~solid & boden
+
+    def verschoben(maske: np.ndarray, dx: int, dy: int) -> np.ndarray:
+        # Wert der Maske an (x + dx, y + dy) fuer jede Zelle (x, y) des Grids
+        return maske[..., rand + dy:rand + dy + hoehe, rand + dx:rand + dx + breite]
+
+    # von soliden Zellen aus gibt es keine Bewegungen, dort kann der Spieler nie sein
+    quelle_frei = ~verschoben(solid, 0, 0)
+    steht = verschoben(boden, 0, 0) & quelle_frei
+
+    spalten = []
+    for richtung in [LINKS, RECHTS]:
+        spalten.append((0, konfig.laufkosten, [(richtung, 0, verschoben(stehbar, richtung, 0) & quelle_frei)]))
+
+    for richtung in [LINKS, RECHTS]:
+        for hoehe_sprung in konfig.sprung_hoehen():
+            # wie berechne_sprung: der weiteste moegliche Sprung wird genommen
+            weite = np.zeros(tiles.shape, dtype=np.int8)
+            for distanz in range(1, konfig.sprung_weite + 1):
+                gueltig = steht & verschoben(stehbar, richtung * distanz, -hoehe_sprung)
+                for zx, zy in zip(*templates[(richtung, hoehe_sprung, distanz)]):
+                    gueltig &= ~verschoben(solid, int(zx), int(zy))
+                weite[gueltig] = distanz
+            spalten.append((1, konfig.springkosten, [(richtung * distanz, -hoehe_sprung, weite == distanz)
+                                                     for distanz in range(1, konfig.sprung_weite + 1)]))
+
+    # wie berechne_fall_position: erste Zelle mit Boden darunter, solange das Grid nicht verlassen wird
+    fallen = []
+    offen = ~verschoben(boden, 0, 0) & quelle_frei
+    for fall_distanz in range(1, konfig.fall_distanz_max + 1):
+        offen &= verschoben(im_grid, 0, fall_distanz)
+        treffer = offen & verschoben(boden, 0, fall_distanz)
+        fallen.append((0, fall_distanz, treffer & ~verschoben(solid, 0, fall_distanz)))
+        offen &= ~treffer
+    spalten.append((2, konfig.fallkosten, fallen))
+
+    return spalten
+
+
+def baue_bewegungsgraph(tiles: np.ndarray, konfig: PhysikKonfig = STANDARD_PHYSIK) -> BewegungsGraph:
+    # baut alle Bewegungen eines Grids in einem Durchlauf als CSR Arrays
+    hoehe, breite = tiles.shape
+    anzahl = hoehe * breite
+    index = np.arange(anzahl).reshape(hoehe, breite)
+
+    spalten_ziele = []
+    spalten_kosten = []
+    spalten_typen = []
+    for typ, kosten, eintraege in berechne_bewegungen(tiles, konfig):
+        ziel = np.full((hoehe, breite), -1, dtype=np.int64)
+        for dx, dy, maske in eintraege:
+            ziel[maske] = index[maske] + dx + dy * breite
+        spalten_ziele.append(ziel.ravel())
+        spalten_kosten.append(kosten)
+        spalten_typen.append(typ)
+
+    # Zeilenweise flach machen haelt die Reihenfolge von finde_alle_nachbarn ein
+    ziele = np.stack(spalten_ziele, axis=1)
+    gueltig = ziele >= 0
+    offsets = np.zeros(anzahl + 1, dtype=np.int64)
+    np.cumsum(gueltig.sum(axis=1), out=offsets[1:])
+    kosten = np.broadcast_to(np.array(spalten_kosten, dtype=np.int64), ziele.shape)[gueltig]
+    typen = np.broadcast_to(np.array(spalten_typen, dtype=np.int8), ziele.shape)[gueltig]
+
+    return BewegungsGraph(breite, hoehe, offsets, ziele[gueltig], kosten, typen)
+
+
 class PhysikEngine:
 
-    def __init__(self, grid: Grid):
+    def __init__(self, grid: Grid, konfig: PhysikKonfig = STANDARD_PHYSIK):
+        self.grid = grid
+        self.konfig = konfig
+        self.templates = sprung_templates(konfig)
+        self.graph: Optional[BewegungsGraph] = None
+        self.solid: Optional[np.ndarray] = None
+        self.grid_version = grid.version
+
+    def binde(self, grid: Grid) -> None:
+        # gleiche Engine (Konfig, Templates) fuer ein anderes Grid
         self.grid = grid
+        self.invalidiere()
+
+    def invalidiere(self) -> None:
+        # nach Aenderungen am Grid muessen Graph und Maske neu berechnet werden
+        self.graph = None
+        self.solid = None
+        self.grid_version = self.grid.version
+
+    def pruefe_aktuell(self) -> None:
+        # Grid.version aendert sich bei jedem set_tile/invalidiere, dann sind Graph und Maske veraltet
+        if self.grid.version != self.grid_version:
+            self.invalidiere()
+
+    def kompiliere(self) -> BewegungsGraph:
+        # Bewegungsgraph wird einmal pro Grid gebaut, danach ist jede Expansion nur noch ein Array Zugriff
+        self.pruefe_aktuell()
+        if self.graph is None:
+            self.graph = baue_bewegungsgraph(self.grid.tiles, self.konfig)
+        return self.graph
+
+    def solid_maske(self) -> np.ndarray:
+        # solide Tiles mit einem Rand aus Luft, damit Sprung-Templates am Rand nicht aus dem Array laufen
+        self.pruefe_aktuell()
+        if self.solid is None:
+            self.solid = np.pad(self.grid.solid_maske(), 1)
+        return self.solid
 
     def ist_position_gueltig(self, pos: Position) -> bool:
         # ist die Position begehbar
@@ -102,12 +367,12 @@ class PhysikEngine:
         if not self.steht_auf_boden(start):
             return None
 
-        if ziel_hoehe > SPRUNG_HOEHE:
+        if ziel_hoehe > self.konfig.sprung_hoehe:
             return None
 
         moegliche_ziele = []
 
-        for horizontale_distanz in range(1, SPRUNG_WEITE + 1):
+        for horizontale_distanz in range(1, self.konfig.sprung_weite + 1):
             ziel_x = start.x + (richtung * horizontale_distanz)
             ziel_y = start.y - ziel_hoehe
             ziel_pos = Position(ziel_x, ziel_y)
@@ -143,6 +408,12 @@ class PhysikEngine:
         if schritte == 0:
             return True
 
+        # bekannter Sprung im Grid: alle Zellen des Templates mit einem Zugriff auf die Maske pruefen
+        template = self.templates.get((int(np.sign(dx)), -dy, abs(dx)))
+        if template is not None and self.grid.ist_im_grid(start.x, start.y) and self.grid.ist_im_grid(ziel.x, ziel.y):
+            zellen_x, zellen_y = template
+            return not self.solid_maske()[zellen_y + start.y + 1, zellen_x + start.x + 1].any()
+
         for i in range(1, schritte + 1):
             t = i / schritte
             zwischen_x = int(start.x + dx * t)
@@ -173,7 +444,7 @@ class PhysikEngine:
 
         for richtung in [LINKS, RECHTS]:
             # am anfang von 0 - sprung hoehe, aber fall sollte auch betrachtet werden, hoher fall sollte aber vermieden werden
-            for hoehe in range(-3, SPRUNG_HOEHE + 1):
+            for hoehe in self.konfig.sprung_hoehen():
                 ziel = self.berechne_sprung(von, richtung, hoehe)
                 if ziel:
                     sprung_ziele.append(ziel)
@@ -187,7 +458,7 @@ class PhysikEngine:
 
         aktuelle_y = von.y
 
-        for fall_distanz in range(1, FALL_DISTANZ_MAX + 1):
+        for fall_distanz in range(1, self.konfig.fall_distanz_max + 1):
             naechste_y = aktuelle_y + fall_distanz
             naechste_pos = Position(von.x, naechste_y)
 
@@ -201,6 +472,30 @@ class PhysikEngine:
                     return None
         return None
 
+    def abhaengige_zellen(self, bewegung: Bewegung) -> Set[Tuple[int, int]]:
+        # alle Zellen, von denen abhaengt ob finde_alle_nachbarn genau diese Bewegung erzeugt
+        # wird keine davon geaendert, ist die Bewegung im geaenderten Grid immer noch gueltig
+        start, ziel = bewegung.start, bewegung.ziel
+        zellen = {(start.x, start.y), (ziel.x, ziel.y), (ziel.x, ziel.y + 1)}
+
+        if bewegung.typ == BewegungTyp.SPRINGEN:
+            zellen.add((start.x, start.y + 1))
+            richtung = RECHTS if ziel.x > start.x else LINKS
+            hoehe = start.y - ziel.y
+            # auch weitere Spruenge mit gleicher Richtung und Hoehe, sonst wuerde berechne_sprung dort landen
+            for distanz in range(abs(ziel.x - start.x), self.konfig.sprung_weite + 1):
+                lande_x = start.x + richtung * distanz
+                zellen.add((lande_x, ziel.y))
+                zellen.add((lande_x, ziel.y + 1))
+                zellen_x, zellen_y = self.templates[(richtung, hoehe, distanz)]
+                zellen.update(zip((zellen_x + start.x).tolist(), (zellen_y + start.y).tolist()))
+
+        elif bewegung.typ == BewegungTyp.FALLEN:
+            # die ganze Spalte bis unter das Ziel bestimmt wo der Fall endet
+            zellen.update((start.x, y) for y in range(start.y + 1, ziel.y + 2))
+
+        return zellen
+
     def finde_alle_nachbarn(self, von: Position) -> List[Bewegung]:
         # finde alle möglichen Bewegungen, die drei Optionen sind laufen, springen, fallen
         bewegungen = []
@@ -208,16 +503,78 @@ class PhysikEngine:
         for richtung in [LINKS, RECHTS]:
             ziel = self.kann_laufen(von, richtung)
             if ziel:
-                bewegungen.append(Bewegung(start=von, ziel=ziel, typ=BewegungTyp.LAUFEN, kosten=LAUFKOSTEN))
+                bewegungen.append(Bewegung(start=von, ziel=ziel, typ=BewegungTyp.LAUFEN, kosten=self.konfig.laufkosten))
 
         if self.steht_auf_boden(von):
             sprung_ziele = self.finde_alle_sprung_ziele(von)
             for ziel in sprung_ziele:
-                bewegungen.append(Bewegung(start=von, ziel=ziel, typ=BewegungTyp.SPRINGEN, kosten=SPRINGKOSTEN))
+                bewegungen.append(Bewegung(start=von, ziel=ziel, typ=BewegungTyp.SPRINGEN, kosten=self.konfig.springkosten))
 
         if not self.steht_auf_boden(von):
             fall_ziel = self.berechne_fall_position(von)
             if fall_ziel:
-                bewegungen.append(Bewegung(start=von, ziel=fall_ziel, typ=BewegungTyp.FALLEN, kosten=FALLKOSTEN))
+                bewegungen.append(Bewegung(start=von, ziel=fall_ziel, typ=BewegungTyp.FALLEN, kosten=self.konfig.fallkosten))
 
         return bewegungen
+
+
+class LoesbarkeitsValidator(LevelValidator):
+    # Notwendige Bedingungen fuer Loesbarkeit, die ohne Pfadsuche mit ein paar Masken auf grid.tiles geprueft werden
+    # Schlaegt eine fehl, ist das Level sicher unloesbar und A* muss nicht gestartet werden
+
+    def __init__(self, konfig: PhysikKonfig = STANDARD_PHYSIK):
+        self.konfig = konfig
+        self.anzahl_geprueft = 0
+        # wie oft welcher Filter ein Level abgelehnt hat
+        self.abgelehnt: Dict[str, int] = {"ungueltig": 0, "ziel_ohne_boden": 0, "ziel_eingemauert": 0,
+                                          "ziel_ausser_reichweite": 0, "ziel_zu_hoch": 0}
+
+    def pruefe(self, grid: Grid) -> Optional[str]:
+        # Rueckgabe: Name des Filters, der das Level ablehnt, sonst None
+        self.anzahl_geprueft += 1
+        grund = self.finde_unloesbarkeit(grid, self.konfig)
+        if grund is not None:
+            self.abgelehnt[grund] += 1
+        return grund
+
+    @staticmethod
+    def finde_unloesbarkeit(grid: Grid, konfig: PhysikKonfig = STANDARD_PHYSIK) -> Optional[str]:
+        gueltig, _ = LevelValidator.ist_gueltig(grid)
+        if not gueltig:
+            return "ungueltig"
+
+        start_x, start_y = grid.get_start()
+        ziel_x, ziel_y = grid.get_ziel()
+
+        solid = grid.solid_maske()
+
+        # jede Bewegung (laufen, springen, fallen) endet auf einer Zelle mit Boden darunter
+        if not grid.hat_boden_darunter(ziel_x, ziel_y):
+            return "ziel_ohne_boden"
+
+        # Laufen kommt nur von links/rechts, jeder Sprung und Fall ins Ziel geht durch die Zelle ueber dem Ziel
+        def blockiert(x: int, y: int) -> bool:
+            return not grid.ist_im_grid(x, y) or bool(solid[y, x])
+
+        if blockiert(ziel_x - 1, ziel_y) and blockiert(ziel_x + 1, ziel_y) and ziel_y > 0 and solid[ziel_y - 1, ziel_x]:
+            return "ziel_eingemauert"
+
+        # Aufwaerts geht es nur mit Spruengen von hoechstens sprung_hoehe, ausser Start und Standplaetzen gibt es
+        # keine Knoten. Eine Luecke zwischen Zeilen mit Standplaetzen die groesser ist, kann nicht ueberwunden werden
+        stehbar = grid.stehbar_maske().copy()
+        zeilen = np.flatnonzero(stehbar.any(axis=1))
+        zeilen = np.union1d(zeilen[(zeilen >= ziel_y) & (zeilen <= start_y)], [ziel_y, start_y])
+        if ziel_y < start_y and np.diff(zeilen).max() > konfig.sprung_hoehe:
+            return "ziel_zu_hoch"
+
+        # Von wo aus kann man das Ziel mit einer Bewegung erreichen? Laufen/Springen nur von Standplaetzen (oder vom
+        # Start) in Sprungweite, Fallen nur vom Start aus derselben Spalte
+        x_min, x_max = max(ziel_x - konfig.sprung_weite, 0), ziel_x + konfig.sprung_weite + 1
+        y_min, y_max = max(ziel_y - konfig.sprung_tiefe, 0), ziel_y + konfig.sprung_hoehe + 1
+        stehbar[:, ziel_x] = False
+        start_in_reichweite = x_min <= start_x < x_max and y_min <= start_y < y_max
+        if not (stehbar[y_min:y_max, x_min:x_max].any() or start_in_reichweite or
+                (start_x == ziel_x and start_y < ziel_y)):
+            return "ziel_ausser_reichweite"
+
+        return None
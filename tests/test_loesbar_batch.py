@@ -0,0 +1,23 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src"), os.path.join(os.path.dirname(__file__), "..")]
+
+from grid import LevelBuilder, Grid
+from autoplayer import Autoplayer
+
+
+@pytest.mark.parametrize("breite, hoehe", [(20, 10), (20, 8), (3, 12), (2, 5), (12, 3)])
+def test_loesbar_batch_wie_autoplayer(breite, hoehe):
+    # loesbar_batch muss fuer jedes Level dasselbe sagen wie die A* Suche, auch bei kleinen Grids
+    rng = np.random.default_rng(breite * 100 + hoehe)
+    stapel = LevelBuilder.zufalls_level_batch(200, breite, hoehe, rng=rng) if breite > 3 and hoehe > 3 else \
+        rng.choice(np.array([0, 0, 0, 1, 2, 3, 4], dtype=np.uint8), size=(200, hoehe, breite))
+
+    loesbar, _ = Autoplayer.loesbar_batch(stapel)
+
+    erwartet = [Autoplayer(Grid.view(level)).ist_level_loesbar() for level in stapel]
+    assert loesbar.tolist() == erwartet